@@ -13,7 +13,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 import sys
+import threading
+from gettext import gettext as _
+
 import gi
 
 gi.require_version('Notify', '0.7')
@@ -24,7 +28,11 @@ from draftsrc.window import ApplicationWindow
 from draftsrc.widgets import preview
 from draftsrc.defs import VERSION as app_version
 from draftsrc.file import init_storage
-from draftsrc.db import init_db
+from draftsrc import importer
+from draftsrc.db import init_db, set_profile, tracer, metadata_cache
+from draftsrc.db import maintenance_step, maintenance_interval
+
+logger = logging.getLogger(__name__)
 
 class Application(Gtk.Application):
     def __repr__(self):
@@ -35,11 +43,14 @@ class Application(Gtk.Application):
                                  flags=Gio.ApplicationFlags.FLAGS_NONE)
         GLib.set_application_name("Draft")
         GLib.set_prgname('draft')
+        self._settings = Gio.Settings.new('org.gnome.Draft')
         init_storage()
+        set_profile(self._settings.get_string('database-profile'))
+        metadata_cache.resize(self._settings.get_uint('metadata-cache-size'))
         init_db(app_version)
         self._init_style()
         self._window = None
-        self._settings = Gio.Settings.new('org.gnome.Draft')
+        self._maintenance_running = False
 
     def _init_style(self):
         css_provider_file = Gio.File.new_for_uri(
@@ -57,11 +68,18 @@ class Application(Gtk.Application):
         self.set_app_menu(appmenu)
 
         action_entries = [
+            ('import', self._import),
             ('preferences', self._preferences),
             ('about', self._about),
             ('quit', self.quit),
         ]
 
+        # a debug action, only there if db queries are being traced
+        if tracer.enabled:
+            action_entries.append(('query-stats', self._query_stats))
+            self.set_accels_for_action('app.query-stats',
+                                       ['<Primary><Shift><Alt>q'])
+
         for action, callback in action_entries:
             simple_action = Gio.SimpleAction.new(action, None)
             simple_action.connect('activate', callback)
@@ -165,6 +183,32 @@ class Application(Gtk.Application):
         preferences_dialog.connect('response', preferences_response)
         preferences_dialog.show()
 
+    def _import(self, action, param):
+        dialog = Gtk.FileChooserDialog(_("Import Folder"), self._window,
+                                       Gtk.FileChooserAction.SELECT_FOLDER,
+                                       (_("_Cancel"), Gtk.ResponseType.CANCEL,
+                                        _("_Import"), Gtk.ResponseType.ACCEPT))
+        response = dialog.run()
+        path = dialog.get_filename()
+        dialog.destroy()
+        if response != Gtk.ResponseType.ACCEPT or not path:
+            return
+
+        def import_finished(group_id):
+            self._window.libraryview.reload_groups(group_id)
+
+        def import_folder():
+            try:
+                group_id = importer.import_folder(path)
+            except Exception:
+                # TODO (notify): folder could not be imported
+                return
+            GLib.idle_add(import_finished, group_id)
+
+        # copying may take a while for large folders
+        thread = threading.Thread(target=import_folder, daemon=True)
+        thread.start()
+
     def _about(self, action, param):
 
         def about_response(dialog, response):
@@ -176,12 +220,32 @@ class Application(Gtk.Application):
         about.connect("response", about_response)
         about.show()
 
+    def _query_stats(self, action, param):
+        logger.info('Query statistics:\n%s', tracer.summary())
+
+    def _on_maintenance_due(self):
+        # steps are run one per idle callback, so that they never hold up
+        # anything else, until there is nothing left to do
+        if not self._maintenance_running:
+            self._maintenance_running = True
+            GLib.idle_add(self._on_maintenance_idle,
+                          priority=GLib.PRIORITY_LOW)
+        return GLib.SOURCE_CONTINUE
+
+    def _on_maintenance_idle(self):
+        if maintenance_step():
+            return GLib.SOURCE_CONTINUE
+        self._maintenance_running = False
+        return GLib.SOURCE_REMOVE
+
     def quit(self, action=None, param=None):
         self._window.destroy()
 
     def do_startup(self):
         Gtk.Application.do_startup(self)
         Notify.init("Draft")
+        GLib.timeout_add_seconds(maintenance_interval,
+                                 self._on_maintenance_due)
         self.builder = Gtk.Builder()
         self._build_app_menu()
 
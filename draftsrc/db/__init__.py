@@ -13,38 +13,129 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 import os.path
-import sqlite3
+from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-from draftsrc.file import USER_DATA_DIR, make_backup
+from draftsrc.file import USER_DATA_DIR
 from draftsrc.db import data
+from draftsrc.db.backup import BackupManager
+from draftsrc.db import journal
+from draftsrc.db.cache import MetadataCache
+from draftsrc.db.maintenance import Maintenance
 from draftsrc.db import requestqueue
-from draftsrc.db.migrations import migrate_db
+from draftsrc.db.migrations import migrate_db, db_versions
+from draftsrc.db.pool import ConnectionPool
+from draftsrc.db.trace import QueryTracer
 
 DB_URL = os.path.join(USER_DATA_DIR, 'draft.db')
+JOURNAL_URL = os.path.join(USER_DATA_DIR, 'pending_updates.journal')
+BACKUP_DIR = os.path.join(USER_DATA_DIR, 'backups')
+SLOW_QUERY_LOG_URL = os.path.join(USER_DATA_DIR, 'slow_queries.log')
 
+logger = logging.getLogger(__name__)
 
-@contextmanager
-def connect():
+# maximum number of reader connections kept open at once, and the number of
+# seconds an unused reader is kept around before being closed
+pool_size = 4
+pool_idle_timeout = 60
+
+# PRAGMAs applied to every new connection. Both profiles use write-ahead
+# logging, so that reads need not wait for the background writers. The 'fast'
+# profile syncs less often; a crash cannot corrupt the db, but a power loss
+# might undo the last few commits.
+pragma_profiles = {
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'busy_timeout': 5000,
+        'mmap_size': 0,
+        'cache_size': -2000
+    },
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 268435456,
+        'cache_size': -16000
+    }
+}
+default_profile = 'durable'
+
+connection_pool = ConnectionPool(DB_URL, pool_size, pool_idle_timeout,
+                                 pragma_profiles[default_profile])
+
+# maximum number of texts and groups whose metadata is kept in memory, so that
+# they need not be fetched again, as long as they do not change; the app
+# resizes the cache as given by its 'metadata-cache-size' setting
+metadata_cache_size = 1000
+metadata_cache = MetadataCache(metadata_cache_size)
+connection_pool.writer_release_hooks.append(metadata_cache.settle)
+
+# number of snapshots of the db kept around, and the number of seconds after
+# which a new one is taken when the app starts
+backups_to_keep = 3
+backup_interval = 24 * 60 * 60
+backup_manager = BackupManager(DB_URL, BACKUP_DIR, backups_to_keep)
+
+# calls to data-layer functions taking more than `slow_query_threshold` seconds
+# are logged, once tracing is enabled
+slow_query_threshold = 0.1
+tracer = QueryTracer(SLOW_QUERY_LOG_URL, slow_query_threshold)
+
+# number of free pages given back to the file system in one maintenance step,
+# the number of rows inserted or deleted after which statistics for the query
+# planner are gathered again, the approximate number of rows of each index
+# looked at when doing so, and the number of seconds between checks for due
+# maintenance
+vacuum_step_pages = 256
+analyze_after_rows = 1000
+analysis_limit = 400
+maintenance_interval = 60
+maintenance = Maintenance(vacuum_step_pages, analyze_after_rows,
+                          analysis_limit)
+
+
+def set_profile(profile):
+    """Use the PRAGMAs for @profile, one of the keys in `pragma_profiles`, on
+    connections made from now on"""
+    connection_pool.pragmas = pragma_profiles.get(profile,
+                                                  pragma_profiles[default_profile])
+    # drop open connections, so that they are re-made with the new profile
+    connection_pool.close()
+
+
+def connect(readonly=False):
     """Provide a transactional scope around a series of operations.
-    Returns a Connection object representing the db"""
-    connection = sqlite3.connect(DB_URL)
-    connection.isolation_level = None
+    Returns a Connection object representing the db. If @readonly is True,
+    the connection should only be used for reading, which does not have to
+    wait for writes going on in other threads."""
+    if readonly:
+        return connection_pool.reader()
+    return connection_pool.writer()
+
+
+@contextmanager
+def transaction(conn):
+    """Provide a scope within which the statements executed on @conn either
+    all take effect or, if an exception is raised, none of them do. Scopes
+    can be nested."""
+    conn.execute('SAVEPOINT draft_transaction')
     try:
-        yield connection
-        connection.commit()
+        yield conn
     except Exception as e:
-        connection.rollback()
+        conn.execute('ROLLBACK TO draft_transaction')
+        conn.execute('RELEASE draft_transaction')
         raise e
-    finally:
-        connection.close()
+    else:
+        conn.execute('RELEASE draft_transaction')
 
 
 def version():
     """Returns the current db version (stored in user_version pragma)"""
-    with connect() as conn:
+    with connect(readonly=True) as conn:
         cursor = conn.cursor()
         res = cursor.execute('PRAGMA user_version')
         return res.fetchone()[0]
@@ -52,7 +143,7 @@ def version():
 
 def is_new():
     """Returns True if db has no tables otherwise False"""
-    with connect() as conn:
+    with connect(readonly=True) as conn:
         cursor = conn.cursor()
         res = cursor.execute('''
             SELECT count(*) FROM sqlite_master WHERE type = "table"
@@ -60,14 +151,44 @@ def is_new():
         return res.fetchone()[0] == 0
 
 
-def init_db(app_version):
+def init_db(app_version, progress_fn=None):
     """Perform some initial work to set up db for use with the current
-    application version"""
+    application version. @progress_fn, if given, is called as migration steps
+    are made; see `migrations.MigrationRunner` for its arguments."""
     # if existing db, then migration needed
     if not is_new():
-        with make_backup(DB_URL):
-            migrate_db(app_version)
-            return
+        # dbs created by older builds of this version of the app were never
+        # stamped with a version, even though they have the version 1 tables
+        if version() == 0:
+            with connect() as connection:
+                res = connection.execute('''
+                    SELECT count(*) FROM sqlite_master WHERE name = "text"
+                ''')
+                if res.fetchone()[0]:
+                    connection.execute('PRAGMA user_version = 1')
+
+        if version() != db_versions[app_version]:
+            # the snapshot holds the db as it was before migrating, though
+            # migrating need not wait for it to be written
+            snapshot_paths = []
+            backup_manager.snapshot(snapshot_paths.append)
+            try:
+                migrate_db(app_version, progress_fn)
+            except Exception:
+                # steps are committed one by one, so the db is left half way
+                # between two versions, which the app must not go on with
+                # TODO (notify): something went wrong
+                logger.exception('Migrating the db to version %d failed',
+                                 db_versions[app_version])
+                restore_failed_migration(snapshot_paths)
+                raise
+            finally:
+                metadata_cache.clear()
+        else:
+            backup_if_due()
+
+        apply_journaled_updates()
+        return
     else:
         with connect() as connection:
             cursor = connection.cursor()
@@ -133,6 +254,63 @@ def init_db(app_version):
                 # TODO (notify): something went wrong
                 pass
 
+            cursor.execute('PRAGMA user_version = 1')
+
+        # later additions to the schema are made by the migration scripts
+        migrate_db(app_version, progress_fn)
+
+
+def backup_if_due():
+    """Start taking a snapshot of the db in the background, if the last one
+    was taken more than `backup_interval` seconds ago"""
+    age = backup_manager.latest_snapshot_age()
+    if age is None or age > backup_interval:
+        backup_manager.snapshot()
+
+
+def restore_backup(path):
+    """Replace the contents of the db with the snapshot at @path, e.g. one of
+    `backup_manager.snapshots()`"""
+    with connect() as connection:
+        backup_manager.restore(path, connection)
+    # no connection should go on reading the db as it was
+    connection_pool.close()
+    metadata_cache.clear()
+
+
+def restore_failed_migration(snapshot_paths):
+    """Put the db back the way it was before a migration that failed, from the
+    snapshot whose path is in @snapshot_paths once it has been written. If
+    there is no snapshot, the db is left as it is, and the migration resumes
+    from the step that failed the next time it is run."""
+    backup_manager.wait()
+    path = snapshot_paths[0] if snapshot_paths else None
+    if path is None:
+        logger.error('No snapshot of the db was taken before migrating; the '
+                     'migration resumes from the failed step on the next '
+                     'start')
+        return
+
+    try:
+        restore_backup(path)
+    except Exception:
+        # TODO (notify): the snapshot is still there to be restored by hand
+        logger.exception('Restoring the db from %s failed', path)
+        return
+
+    logger.error('The db was restored from %s, taken before migrating, at '
+                 'version %d', path, version())
+
+
+def maintenance_step():
+    """Do one small piece of due maintenance on db, e.g. from an idle
+    callback. Returns True if there is more to do right away, or False if
+    there is nothing left or the writer is busy, so that it is tried later."""
+    with connection_pool.writer(blocking=False) as connection:
+        if connection is None:
+            return False
+        return maintenance.step(connection)
+
 
 def get_datetime():
     return datetime.now().isoformat(timespec='milliseconds')
@@ -158,10 +336,12 @@ def get_datetime_from_string(dt_str):
     return datetime.strptime(dt_str, '%Y-%m-%dT%H:%M:%S.%f')
 
 
-# a queue for regular updates that need to be performed immediately
-async_text_updater = requestqueue.UpdateRequestQueue()
-async_text_updater.execution_fn = data.update_text
-async_text_updater.fetch_fn = data.text_for_id
+# a queue for regular updates that need to be performed immediately; callers
+# are made to wait once `max_pending_updates` updates are yet to be written
+max_pending_updates = 1000
+async_text_updater = requestqueue.UpdateRequestQueue(max_size=max_pending_updates)
+async_text_updater.execution_fn = data.update_texts
+async_text_updater.fetch_fn = data.last_modified_for_texts
 
 # a queue for asynchrnously deleting texts immediately
 async_text_deleter = requestqueue.DeleteRequestQueue()
@@ -171,12 +351,85 @@ async_text_deleter.deletion_fn = data.delete_text
 async_group_deleter = requestqueue.DeleteRequestQueue()
 async_group_deleter.deletion_fn = data.delete_group
 
-# TODO: a queue for updates which could be issued periodically
-timed_updater = requestqueue.UpdateRequestQueue()
+# a queue for low priority updates, which are issued periodically (every
+# `time_period` seconds) or once `time_max_pending` updates have piled up
 time_period = 180
+time_max_pending = 50
+timed_updater = requestqueue.TimedUpdateRequestQueue(time_period,
+                                                     time_max_pending)
+timed_updater.execution_fn = data.update_texts
+timed_updater.fetch_fn = data.last_modified_for_texts
 
-# a queue of updates that will be executed when the app quits
-final_text_updater = requestqueue.UpdateRequestQueue(async=False,
+# a queue of updates that are deferred until the app quits; they are kept in
+# a journal file meanwhile and only written to db the next time it starts
+final_text_updater = requestqueue.UpdateRequestQueue(threaded=False,
                                                      immediate_activation=False)
-final_text_updater.execution_fn = data.update_text
-final_text_updater.fetch_fn = data.text_for_id
+final_text_updater.execution_fn = data.update_texts
+final_text_updater.fetch_fn = data.last_modified_for_texts
+final_text_updater.journal = journal.Journal(JOURNAL_URL)
+
+
+def apply_journaled_updates():
+    """Write the deferred updates, left in journal by the last run of the
+    app, to db in a single transaction and then clear the journal. Should
+    that transaction fail, the updates are written one by one and those that
+    still fail are dropped, so that a bad entry cannot stop the app from
+    starting."""
+    try:
+        pending = final_text_updater.journal.replay()
+    except (OSError, UnicodeDecodeError):
+        # TODO (notify): the updates are lost
+        logger.exception('Reading the journal of deferred updates failed')
+        pending = OrderedDict()
+
+    try:
+        if pending:
+            try:
+                with connect() as connection:
+                    with transaction(connection):
+                        batch = OrderedDict(pending)
+                        final_text_updater.drop_outdated(connection, batch)
+                        if batch:
+                            final_text_updater.execution_fn(connection, batch)
+            except Exception:
+                logger.exception('Applying %d deferred updates failed, '
+                                 'retrying them one by one', len(pending))
+                for id, values in pending.items():
+                    final_text_updater.apply_one(id, values)
+    finally:
+        final_text_updater.journal.truncate()
+
+
+def enable_tracing():
+    """Start timing data-layer functions and the statements they execute; see
+    `tracer.summary()` for the results. Meant to be called before the db is
+    used, since connections already open are closed."""
+    if tracer.enabled:
+        return
+
+    tracer.slow_threshold = slow_query_threshold
+    tracer.install(data)
+    tracer.enabled = True
+    connection_pool.open_hooks.append(tracer.attach)
+    connection_pool.close()
+
+    # the queues hold on to the data functions they were given
+    for queue in [async_text_updater, timed_updater, final_text_updater]:
+        queue.execution_fn = data.update_texts
+        queue.fetch_fn = data.last_modified_for_texts
+    async_text_deleter.deletion_fn = data.delete_text
+    async_group_deleter.deletion_fn = data.delete_group
+
+
+def close():
+    """Write out everything still waiting in queues, except the deferred
+    updates that are in the journal, and close the db connections, meant to be
+    called once when the app quits"""
+    timed_updater.flush(wait=True)
+    for queue in [async_text_updater, timed_updater,
+                  async_text_deleter, async_group_deleter]:
+        queue.close()
+    final_text_updater.journal.close()
+    with connect() as connection:
+        maintenance.optimize(connection)
+    connection_pool.close()
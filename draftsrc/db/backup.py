@@ -0,0 +1,165 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+
+class BackupManager(object):
+    """Takes snapshots of the db at @url into @backup_dir using the sqlite
+    online backup API, keeping only the @keep most recent ones.
+
+    A snapshot is copied @pages_per_step pages at a time on a background
+    thread, from a connection that holds a single read transaction for the
+    whole copy. With the db in WAL mode, writes made meanwhile neither wait
+    for the copy nor end up in it, so a snapshot is the state of the db at the
+    moment it was started."""
+
+    suffix = '.db'
+    partial_suffix = '.partial'
+
+    def __init__(self, url, backup_dir, keep=3, pages_per_step=1024,
+                 step_delay=0.05):
+        self.url = url
+        self.backup_dir = backup_dir
+        self.keep = keep
+        self.pages_per_step = pages_per_step
+        # seconds to wait between steps, leaving the disk to the app meanwhile
+        self.step_delay = step_delay
+
+        # (pages copied, total pages) of the snapshot being taken, if any
+        self.progress = None
+
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _name_for_snapshot(self):
+        basename = os.path.splitext(os.path.basename(self.url))[0]
+        timestamp = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        return os.path.join(self.backup_dir,
+                            '%s_%s%s' % (basename, timestamp, self.suffix))
+
+    def snapshots(self):
+        """Return the paths of complete snapshots, the most recent first"""
+        if not os.path.isdir(self.backup_dir):
+            return []
+
+        paths = [os.path.join(self.backup_dir, name)
+                 for name in os.listdir(self.backup_dir)
+                 if name.endswith(self.suffix)]
+        # timestamps in names sort the same way as the times they stand for
+        return sorted(paths, reverse=True)
+
+    def latest_snapshot_age(self):
+        """Return the number of seconds since the most recent snapshot was
+        taken, or None if there is none"""
+        snapshots = self.snapshots()
+        if not snapshots:
+            return None
+        return time.time() - os.path.getmtime(snapshots[0])
+
+    def is_running(self):
+        """Whether a snapshot is being taken right now"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def snapshot(self, done_fn=None):
+        """Start taking a snapshot in the background, unless one is already
+        being taken, and return once its read transaction has begun; changes
+        committed after that are not part of it. @done_fn, if given, is called
+        from the background thread with the path of the snapshot, or None if
+        it failed."""
+        with self._lock:
+            if self.is_running():
+                return
+
+            os.makedirs(self.backup_dir, exist_ok=True)
+            self._remove_partial()
+
+            source = sqlite3.connect(self.url, check_same_thread=False)
+            source.isolation_level = None
+            try:
+                # reading anything pins the db as it is now for the source
+                source.execute('BEGIN')
+                source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+            except Exception as e:
+                source.close()
+                raise e
+
+            self.progress = (0, 0)
+            self._thread = threading.Thread(target=self._copy,
+                                            args=(source, done_fn),
+                                            daemon=True)
+            self._thread.start()
+
+    def _copy(self, source, done_fn):
+        path = self._name_for_snapshot()
+        partial_path = path + self.partial_suffix
+
+        def on_progress(status, remaining, total):
+            self.progress = (total - remaining, total)
+
+        try:
+            target = sqlite3.connect(partial_path)
+            try:
+                source.backup(target,
+                              pages=self.pages_per_step,
+                              progress=on_progress,
+                              sleep=self.step_delay)
+            finally:
+                target.close()
+            os.replace(partial_path, path)
+        except Exception:
+            # TODO (notify): backup could not be made
+            path = None
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        finally:
+            source.close()
+            self.progress = None
+
+        if path is not None:
+            self._rotate()
+        if done_fn:
+            done_fn(path)
+
+    def _rotate(self):
+        """Delete all but the @keep most recent snapshots"""
+        for path in self.snapshots()[self.keep:]:
+            os.remove(path)
+
+    def _remove_partial(self):
+        """Delete snapshots left unfinished, e.g. by the app quitting while
+        they were being taken"""
+        for name in os.listdir(self.backup_dir):
+            if name.endswith(self.partial_suffix):
+                os.remove(os.path.join(self.backup_dir, name))
+
+    def wait(self, timeout=None):
+        """Block until the snapshot being taken, if any, is complete"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def restore(self, path, conn):
+        """Overwrite the db that @conn is connected to with the snapshot at
+        @path; @conn must not be in a transaction"""
+        source = sqlite3.connect(path)
+        try:
+            source.backup(conn, pages=-1)
+        finally:
+            source.close()
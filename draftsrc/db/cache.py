@@ -0,0 +1,115 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import OrderedDict
+
+
+class MetadataCache(object):
+    """A least-recently-used cache of metadata fetched from db, keyed by kind
+    (e.g. 'text' or 'group') and id, holding at most @size items.
+
+    Items changed by a write are invalidated right away, and once more when
+    the writer is released, since until then the write may not have been
+    committed. Items being written are not cached in between. Every
+    invalidation moves the cache to a new generation; a value loaded while
+    the generation changed is returned, but not cached, as it may be stale."""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._pending = set()
+        self._pending_kinds = set()
+
+    def get(self, kind, id, load_fn):
+        """Return the cached value for @kind and @id, or if there is none, the
+        value returned by @load_fn, which is then cached"""
+        key = (kind, id)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            generation = self._generation
+
+        value = load_fn()
+
+        with self._lock:
+            if (generation == self._generation
+                    and key not in self._pending
+                    and kind not in self._pending_kinds):
+                self._items[key] = value
+                while len(self._items) > self.size:
+                    self._items.popitem(last=False)
+
+        return value
+
+    def invalidate(self, kind, ids=None):
+        """Drop the cached values of @kind for the given @ids, or all values
+        of @kind if @ids is None, as they are being changed"""
+        with self._lock:
+            if ids is None:
+                for key in [key for key in self._items if key[0] == kind]:
+                    del self._items[key]
+                self._pending_kinds.add(kind)
+            else:
+                for id in ids:
+                    self._items.pop((kind, id), None)
+                    self._pending.add((kind, id))
+            self._generation += 1
+
+    def settle(self):
+        """Drop the values invalidated since this was last called, once more,
+        now that changes to them have been committed or rolled back"""
+        with self._lock:
+            if not (self._pending or self._pending_kinds):
+                return
+
+            for key in self._pending:
+                self._items.pop(key, None)
+            for key in [key for key in self._items
+                        if key[0] in self._pending_kinds]:
+                del self._items[key]
+            self._pending = set()
+            self._pending_kinds = set()
+            self._generation += 1
+
+    def clear(self):
+        """Drop all cached values"""
+        with self._lock:
+            self._items.clear()
+            self._generation += 1
+
+    def resize(self, size):
+        """Hold at most @size items from now on"""
+        with self._lock:
+            self.size = size
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        """Return a dict of counters describing cache usage so far"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'items': len(self._items),
+            'size': self.size
+        }
@@ -13,9 +13,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 from hashlib import sha256
+from types import MappingProxyType
 
 from draftsrc import db
+from draftsrc.db.records import TextRecord, TagStats
 
 
 def create_tag(conn, label):
@@ -24,6 +27,7 @@ def create_tag(conn, label):
         INSERT INTO tag (keyword)
              VALUES (:label)'''
     cursor = conn.cursor()
+    db.metadata_cache.invalidate('tags')
     cursor.execute(query, {'label': label})
 
 
@@ -31,40 +35,105 @@ def create_text(conn, name, group_id=None):
     """Create a new text document and return its id"""
     datetime = db.get_datetime()
     query = '''
-        INSERT INTO text (created, last_modified, title, parent_id, in_trash)
-             VALUES (:created, :modified, :title, :parent_id, :in_trash)'''
+        INSERT INTO text (created, last_modified, title, parent_id, in_trash,
+                          hash_id)
+             VALUES (:created, :modified, :title, :parent_id, :in_trash,
+                     :hash_id)'''
     cursor = conn.cursor()
     cursor.execute(query, {"created": datetime,
                            "modified": datetime,
                            "title": name,
                            "parent_id": group_id,
-                           "in_trash": 0})
+                           "in_trash": 0,
+                           "hash_id": hash_for_creation_datetime(datetime)})
 
-    return get_last_insert_id(conn)
+    text_id = get_last_insert_id(conn)
+    db.metadata_cache.invalidate('text', [text_id])
+    return text_id
 
 
 def create_group(conn, name, group_id=None):
     """Create a new text group and return its id"""
     datetime = db.get_datetime()
+    hash_id = hash_for_creation_datetime(datetime)
     query = '''
-        INSERT INTO "group" (created, last_modified, name, parent_id, in_trash)
-             VALUES (:created, :modified, :name, :parent_id, :in_trash)'''
+        INSERT INTO "group" (created, last_modified, name, parent_id, in_trash,
+                             hash_id, path)
+             VALUES (:created, :modified, :name, :parent_id, :in_trash,
+                     :hash_id, :path)'''
     cursor = conn.cursor()
     cursor.execute(query, {"created": datetime,
                            "modified": datetime,
                            "name": name,
                            "parent_id": group_id,
-                           "in_trash": 0})
+                           "in_trash": 0,
+                           "hash_id": hash_id,
+                           "path": path_for_group(conn, group_id, hash_id)})
 
-    return get_last_insert_id(conn)
+    group_id = get_last_insert_id(conn)
+    db.metadata_cache.invalidate('group', [group_id])
+    return group_id
+
+
+def next_group_id(conn):
+    """Return the id that the next group created will get"""
+    query = 'SELECT ifnull(max(id), 0) + 1 FROM "group"'
+    cursor = conn.cursor()
+    res = cursor.execute(query)
+    return res.fetchone()[0]
+
+
+def create_groups(conn, groups):
+    """Create all @groups, a list of dicts of group values including their
+    'id', 'hash_id' and 'path', in a single transaction. A group has to come
+    after the group it is in, if that is also in @groups."""
+    query = '''
+        INSERT INTO "group" (id, created, last_modified, name, parent_id,
+                             in_trash, hash_id, path)
+             VALUES (:id, :created, :last_modified, :name, :parent_id, 0,
+                     :hash_id, :path)'''
+    cursor = conn.cursor()
+    db.metadata_cache.invalidate('group', [group['id'] for group in groups])
+    with db.transaction(conn):
+        cursor.executemany(query, groups)
+    db.maintenance.note_changes(len(groups))
+
+
+def create_texts(conn, texts):
+    """Create all @texts, a list of dicts of text values including their
+    'hash_id', in a single transaction and return their ids in the same
+    order"""
+    query = '''
+        INSERT INTO text (created, last_modified, title, parent_id, in_trash,
+                          hash_id)
+             VALUES (:created, :last_modified, :title, :parent_id, 0,
+                     :hash_id)'''
+    cursor = conn.cursor()
+    with db.transaction(conn):
+        cursor.executemany(query, texts)
+        # each new rowid is one more than the largest one so far
+        last_id = get_last_insert_id(conn)
+
+    text_ids = list(range(last_id - len(texts) + 1, last_id + 1))
+    db.metadata_cache.invalidate('text', text_ids)
+    db.maintenance.note_changes(len(texts))
+    return text_ids
+
+
+def creation_datetimes(conn):
+    """Return the set of datetimes at which existing texts and groups were
+    created, which new ones must not share as their hash ids would clash"""
+    query = '''
+        SELECT created FROM text
+         UNION
+        SELECT created FROM "group"'''
+    cursor = conn.cursor()
+    return {row[0] for row in cursor.execute(query)}
 
 
 def get_last_insert_id(conn):
     """Returns the rowid of the last row that was inserted through the active
     connection"""
-    # premature commit to ensure we get proper id
-    conn.commit()
-
     id_query = 'SELECT last_insert_rowid()'
     cursor = conn.cursor()
     res = cursor.execute(id_query)
@@ -73,6 +142,12 @@ def get_last_insert_id(conn):
 
 def update_text(conn, text_id, values):
     """Update the values for given text id"""
+    update_texts(conn, {text_id: values})
+
+
+def update_texts(conn, texts):
+    """Update the values for all texts in @texts, a dict of text ids mapped to
+    their values, in a single transaction"""
     query = '''
         UPDATE text
            SET last_modified = :modified
@@ -84,44 +159,75 @@ def update_text(conn, text_id, values):
              , word_goal = :word_goal
              , last_edit_position = :last_edit_position
          WHERE id = :id'''
+    args = []
+    for text_id, values in texts.items():
+        args.append({"modified": values['last_modified'],
+                     "title": values['title'],
+                     "parent_id": values['parent_id'],
+                     "in_trash": values['in_trash'],
+                     "markup": values['markup'],
+                     "subtitle": values['subtitle'],
+                     "word_goal": values['word_goal'],
+                     "last_edit_position": values['last_edit_position'],
+                     "id": text_id})
+
+    trash_query = '''
+        SELECT id, in_trash
+          FROM text
+         WHERE id IN (%s)''' % ', '.join(str(int(i)) for i in texts)
+
     cursor = conn.cursor()
-    cursor.execute(query, {"modified": values['last_modified'],
-                           "title": values['title'],
-                           "parent_id": values['parent_id'],
-                           "in_trash": values['in_trash'],
-                           "markup": values['markup'],
-                           "subtitle": values['subtitle'],
-                           "word_goal": values['word_goal'],
-                           "last_edit_position": values['last_edit_position'],
-                           "id": text_id})
+    db.metadata_cache.invalidate('text', list(texts))
+    with db.transaction(conn):
+        # tag statistics count trashed texts apart from the others, and are
+        # otherwise only changed along with the tags themselves
+        for text_id, in_trash in cursor.execute(trash_query).fetchall():
+            if bool(in_trash) != bool(texts[text_id]['in_trash']):
+                db.metadata_cache.invalidate('tags')
+                break
 
-    update_tags_for_text(conn, text_id, values['tags'])
+        cursor.executemany(query, args)
+        for text_id, values in texts.items():
+            update_tags_for_text(conn, text_id, values['tags'])
 
 
 def update_tags_for_text(conn, text_id, labels):
-    """Update the tags on given text"""
-    values = []
-    for l in labels:
-        label = fetch_label(conn, l)
-        values.append({"text_id": text_id, "tag_label": label})
-
-    cursor = conn.cursor()
-
-    # remove old tags if any
+    """Update the tags on given text to be @labels. Only the tags added or
+    removed are written, and tags no longer on any text are deleted along the
+    way, by triggers counting the texts each tag is on."""
+    select_query = '''
+        SELECT tag_keyword
+          FROM text_tags
+         WHERE text_id = :id'''
     delete_query = '''
         DELETE FROM text_tags
-              WHERE text_id = :id'''
-    cursor.execute(delete_query, {"id": text_id})
-
-    # add new tags if any
+              WHERE text_id = :text_id
+                AND tag_keyword = :tag_label'''
     insert_query = '''
         INSERT INTO text_tags (text_id, tag_keyword)
              VALUES (:text_id, :tag_label)'''
-    cursor.executemany(insert_query, values)
+
+    cursor = conn.cursor()
+    res = cursor.execute(select_query, {"id": text_id})
+    old_labels = set(row[0] for row in res.fetchall())
+    new_labels = set(labels)
+    if old_labels == new_labels:
+        return
+
+    db.metadata_cache.invalidate('text', [text_id])
+    db.metadata_cache.invalidate('tags')
+    with db.transaction(conn):
+        cursor.executemany(delete_query, [
+            {"text_id": text_id, "tag_label": label}
+            for label in old_labels - new_labels])
+        cursor.executemany(insert_query, [
+            {"text_id": text_id, "tag_label": fetch_label(conn, label)}
+            for label in new_labels - old_labels])
 
 
 def update_group(conn, group_id, values):
-    """Update the values for given group id"""
+    """Update the values for given group id. Returns a list of ids of texts
+    that were trashed or restored along with the group, if any."""
     original_values = group_for_id(conn, group_id)
     datetime = db.get_datetime()
     update_query = '''
@@ -132,84 +238,310 @@ def update_group(conn, group_id, values):
              , in_trash = :in_trash
          WHERE id = :group_id'''
     cursor = conn.cursor()
-    cursor.execute(update_query, {"modified": datetime,
-                                  "name": values['name'],
-                                  "parent_id": values['parent_id'],
-                                  "in_trash": values['in_trash'],
-                                  "group_id": group_id})
-
-    # trash/untrash items in group, if the group is being trashed/untrashed
-    if values['in_trash'] != original_values['in_trash']:
-
-        # recursive function that sets `in_trash`
-        # for given group, its subgroups and texts.
-        def set_in_trash_groups_and_texts(conn, group, in_trash):
-            trash_group_query = '''
-                UPDATE "group"
-                   SET in_trash = :in_trash
-                 WHERE id = :id'''
-            cursor.execute(trash_group_query,
-                           {"id": group, 'in_trash': in_trash})
-
-            trash_texts_query = '''
-                UPDATE text
-                   SET in_trash = :in_trash
-                     , last_modified = :datetime
-                 WHERE parent_id = :id'''
-            cursor.execute(trash_texts_query,
-                           {"id": group, 'in_trash': in_trash, 'datetime': datetime})
-            conn.commit()
-
-            select_subgroups_query = '''
-                SELECT id, name
+    db.metadata_cache.invalidate('group', [group_id])
+    with db.transaction(conn):
+        cursor.execute(update_query, {"modified": datetime,
+                                      "name": values['name'],
+                                      "parent_id": values['parent_id'],
+                                      "in_trash": values['in_trash'],
+                                      "group_id": group_id})
+
+        # paths of the group and everything under it change, if it is moved
+        if values['parent_id'] != original_values['parent_id']:
+            update_path_for_group(conn, group_id, values['parent_id'])
+
+        # trash/untrash items in group, if the group is being trashed/untrashed
+        if values['in_trash'] != original_values['in_trash']:
+            return set_in_trash_for_group(conn,
+                                          group_id,
+                                          values['in_trash'],
+                                          datetime)
+
+    return []
+
+
+def move_texts_to_group(conn, text_ids, group_id, datetime):
+    """Move the texts with @text_ids into the group with @group_id, or to the
+    top level if it is None, in a single transaction. The texts and the group
+    are marked as modified at @datetime."""
+    move_query = '''
+        UPDATE text
+           SET parent_id = :group_id
+             , last_modified = :datetime
+         WHERE id IN (%s)''' % ', '.join(str(int(i)) for i in text_ids)
+    touch_query = '''
+        UPDATE "group"
+           SET last_modified = :datetime
+         WHERE id = :group_id'''
+    args = {"group_id": group_id, "datetime": datetime}
+    cursor = conn.cursor()
+    db.metadata_cache.invalidate('text', text_ids)
+    db.metadata_cache.invalidate('group', [group_id])
+    with db.transaction(conn):
+        cursor.execute(move_query, args)
+        if group_id is not None:
+            cursor.execute(touch_query, args)
+
+
+def set_in_trash_for_group(conn, group_id, in_trash, datetime):
+    """Set `in_trash` for given group, its subgroups and the texts within
+    them. Returns a list of ids of texts whose `in_trash` value changed."""
+    subtree = '''
+        WITH RECURSIVE subtree (id) AS (
+                SELECT :id
+             UNION ALL
+                SELECT "group".id
                   FROM "group"
-                 WHERE parent_id = :id'''
-            res = cursor.execute(select_subgroups_query, {'id': group})
-            for subgroup in res.fetchall():
-                set_in_trash_groups_and_texts(conn, subgroup[0], in_trash)
+                  JOIN subtree ON "group".parent_id = subtree.id)
+    '''
+    select_texts_query = subtree + '''
+        SELECT id
+          FROM text
+         WHERE parent_id IN subtree
+           AND in_trash != :in_trash'''
+    trash_groups_query = subtree + '''
+        UPDATE "group"
+           SET in_trash = :in_trash
+         WHERE id IN subtree'''
+    trash_texts_query = subtree + '''
+        UPDATE text
+           SET in_trash = :in_trash
+             , last_modified = :datetime
+         WHERE parent_id IN subtree'''
 
-        set_in_trash_groups_and_texts(conn, group_id, values['in_trash'])
+    args = {"id": group_id, "in_trash": in_trash, "datetime": datetime}
+    cursor = conn.cursor()
+    db.metadata_cache.invalidate('group')
+    db.metadata_cache.invalidate('text')
+    db.metadata_cache.invalidate('tags')
+    with db.transaction(conn):
+        res = cursor.execute(select_texts_query, args)
+        text_ids = [row[0] for row in res.fetchall()]
+        cursor.execute(trash_groups_query, args)
+        cursor.execute(trash_texts_query, args)
 
+    return text_ids
+
+
+def path_for_group(conn, parent_id, group_hash):
+    """Returns the path string for a group with @group_hash as hash_id, within
+    the group with @parent_id"""
+    if parent_id is None:
+        return group_hash
 
-def delete_text(conn, text_id):
-    """Delete a text document from db"""
     query = '''
-        DELETE FROM text
-              WHERE id = :id'''
+        SELECT path
+          FROM "group"
+         WHERE id = :id'''
     cursor = conn.cursor()
-    cursor.execute(query, {"id": text_id})
+    res = cursor.execute(query, {"id": parent_id}).fetchone()
+    return '/'.join([res[0], group_hash])
 
 
-def delete_group(conn, group_id):
-    """Delete a text group from db"""
+def update_path_for_group(conn, group_id, parent_id):
+    """Set the path for the group with @group_id, which has been moved into the
+    group with @parent_id, and rewrite paths of groups under it to match"""
+    cursor = conn.cursor()
+
+    # parents of all groups and texts under the group change
+    db.metadata_cache.invalidate('group')
+    db.metadata_cache.invalidate('text')
+
     query = '''
+        SELECT path, hash_id
+          FROM "group"
+         WHERE id = :id'''
+    old_path, group_hash = cursor.execute(query, {"id": group_id}).fetchone()
+    new_path = path_for_group(conn, parent_id, group_hash)
+
+    update_query = '''
+        UPDATE "group"
+           SET path = :new_path
+         WHERE id = :id'''
+    cursor.execute(update_query, {"new_path": new_path, "id": group_id})
+
+    # descendant paths are the ones starting with "<old_path>/"; "0" is the
+    # character right after "/", so this range check can make use of the index
+    descendants_query = '''
+        UPDATE "group"
+           SET path = :new_path || substr(path, :old_length + 1)
+         WHERE path > :old_path || '/'
+           AND path < :old_path || '0'
+    '''
+    cursor.execute(descendants_query, {"new_path": new_path,
+                                       "old_path": old_path,
+                                       "old_length": len(old_path)})
+
+
+def delete_text(conn, text_id):
+    """Delete a text document from db, along with its tag associations and
+    any tags that are no longer associated with a text"""
+    where_condition = 'id = :id'
+    args = {"id": text_id}
+    delete_texts(conn, where_condition, args)
+
+
+def delete_group(conn, group_id):
+    """Delete a text group from db, along with all groups and texts under it.
+    Returns a dict with counts of deleted 'groups', 'texts' and 'tags'."""
+    subtree_query = '''
+        WITH RECURSIVE subtree (id) AS (
+                SELECT :id
+             UNION ALL
+                SELECT "group".id
+                  FROM "group"
+                  JOIN subtree ON "group".parent_id = subtree.id)
+        SELECT id
+          FROM subtree'''
+    delete_groups_query = '''
         DELETE FROM "group"
-              WHERE id = :id'''
-    cursor = conn.cursor()
-    cursor.execute(query, {"id": group_id})
+              WHERE id IN (%s)'''
 
-    # delete texts belonging to group from the db
+    cursor = conn.cursor()
+    db.metadata_cache.invalidate('group')
+    with db.transaction(conn):
+        res = cursor.execute(subtree_query, {"id": group_id})
+        group_ids = ', '.join(str(row[0]) for row in res.fetchall())
+        counts = delete_texts(conn, 'parent_id IN (%s)' % group_ids)
+        cursor.execute(delete_groups_query % group_ids)
+        counts['groups'] = cursor.rowcount
+    db.maintenance.note_changes(counts['groups'])
+
+    return counts
+
+
+def delete_texts(conn, where_condition, args={}):
+    """Delete texts satisfying @where_condition, their tag associations and
+    any tags left without a text. Returns a dict with counts of deleted
+    'texts' and 'tags'."""
+    texts_query = 'SELECT id FROM text WHERE %s' % where_condition
+    # tags only on these texts, that triggers delete along with them
+    count_tags_query = '''
+        SELECT COUNT(*)
+          FROM (SELECT tag_keyword, COUNT(*) AS texts
+                  FROM text_tags
+                 WHERE text_id IN (%s)
+              GROUP BY tag_keyword) AS tagged
+          JOIN tag_stats
+            ON tag_stats.tag_keyword = tagged.tag_keyword
+         WHERE tag_stats.refs = tagged.texts''' % texts_query
+    delete_text_tags_query = '''
+        DELETE FROM text_tags
+              WHERE text_id IN (%s)''' % texts_query
     delete_texts_query = '''
         DELETE FROM text
-              WHERE parent_id = :id'''
-    cursor.execute(delete_texts_query, {"id": group_id})
+              WHERE %s''' % where_condition
 
-    select_query = '''
-        SELECT id
-          FROM "group"
-         WHERE parent_id = :id'''
-    res = cursor.execute(select_query, {'id': group_id})
-    for row in res.fetchall():
-        delete_group(conn, row[0])
+    cursor = conn.cursor()
+    db.metadata_cache.invalidate('text')
+    db.metadata_cache.invalidate('tags')
+    with db.transaction(conn):
+        res = cursor.execute(count_tags_query, args)
+        num_tags = res.fetchone()[0]
+        cursor.execute(delete_text_tags_query, args)
+        cursor.execute(delete_texts_query, args)
+        num_texts = cursor.rowcount
+    db.maintenance.note_changes(num_texts + num_tags)
+
+    return {'texts': num_texts, 'tags': num_tags}
+
+
+def _keyword_args(keywords):
+    """Return a string of named parameters for an `IN (...)` list of
+    @keywords, and a dict of the values to bind to them"""
+    args = {'keyword%d' % i: keyword for i, keyword in enumerate(keywords)}
+    return ', '.join(':%s' % name for name in args), args
+
+
+def merge_tags(conn, keywords, new_keyword):
+    """Replace the tags with @keywords by the tag with @new_keyword on all
+    texts, creating it if needed, and delete the replaced tags, in a single
+    transaction. Returns a list of ids of texts whose tags changed."""
+    keywords = [keyword for keyword in keywords if keyword != new_keyword]
+    if not keywords:
+        return []
+
+    params, args = _keyword_args(keywords)
+    args['new_keyword'] = new_keyword
+    select_texts_query = '''
+        SELECT DISTINCT text_id
+          FROM text_tags
+         WHERE tag_keyword IN (%s)''' % params
+    # texts already tagged with @new_keyword keep their old tags here, which
+    # are deleted next
+    replace_query = '''
+        UPDATE OR IGNORE text_tags
+           SET tag_keyword = :new_keyword
+         WHERE tag_keyword IN (%s)''' % params
+    delete_text_tags_query = '''
+        DELETE FROM text_tags
+              WHERE tag_keyword IN (%s)''' % params
+    # tags on any text are deleted by triggers along with their last text_tags
+    # row, unused ones are not
+    delete_tags_query = '''
+        DELETE FROM tag
+              WHERE keyword IN (%s)''' % params
+
+    cursor = conn.cursor()
+    db.metadata_cache.invalidate('tags')
+    with db.transaction(conn):
+        res = cursor.execute(select_texts_query, args)
+        text_ids = [row[0] for row in res.fetchall()]
+        db.metadata_cache.invalidate('text', text_ids)
+        if text_ids:
+            fetch_label(conn, new_keyword)
+            cursor.execute(replace_query, args)
+            cursor.execute(delete_text_tags_query, args)
+        cursor.execute(delete_tags_query, args)
+
+    return text_ids
+
+
+def rename_tag(conn, keyword, new_keyword):
+    """Rename the tag with @keyword to @new_keyword on all texts; if a tag with
+    @new_keyword exists, the two are merged. Returns a list of ids of texts
+    whose tags changed."""
+    return merge_tags(conn, [keyword], new_keyword)
+
+
+def delete_tag(conn, keyword):
+    """Remove the tag with @keyword from all texts and delete it, in a single
+    transaction. Returns a list of ids of texts whose tags changed."""
+    select_texts_query = '''
+        SELECT text_id
+          FROM text_tags
+         WHERE tag_keyword = :keyword'''
+    delete_text_tags_query = '''
+        DELETE FROM text_tags
+              WHERE tag_keyword = :keyword'''
+    delete_tag_query = '''
+        DELETE FROM tag
+              WHERE keyword = :keyword'''
+
+    args = {"keyword": keyword}
+    cursor = conn.cursor()
+    db.metadata_cache.invalidate('tags')
+    with db.transaction(conn):
+        res = cursor.execute(select_texts_query, args)
+        text_ids = [row[0] for row in res.fetchall()]
+        db.metadata_cache.invalidate('text', text_ids)
+        cursor.execute(delete_text_tags_query, args)
+        cursor.execute(delete_tag_query, args)
+
+    return text_ids
 
 
 def delete_orphan_tags(conn):
-    """Delete tags not associated with  any text"""
+    """Delete tags not associated with any text. Triggers delete tags as soon
+    as they are taken off their last text, so this only finds tags left over
+    by e.g. a tag created but never used; it scans the whole tag table and is
+    meant as an occasional consistency check."""
     orphan_tags_query = '''
         DELETE FROM tag
               WHERE keyword NOT IN (SELECT tag_keyword
                                       FROM text_tags)'''
     cursor = conn.cursor()
+    db.metadata_cache.invalidate('tags')
     cursor.execute(orphan_tags_query)
 
 
@@ -248,28 +580,61 @@ def hash_for_creation_datetime(datetime):
 def fetch_parents_for_text(conn, text_id):
     """Returns a list of hash strings for parent groups that joined
     together can form a relative path to text dir"""
+    query = 'SELECT parent_id FROM text WHERE id = :id'
+    paths = fetch_paths_for_groups(conn, query, {"id": text_id})
+    return paths.get(text_id, [])
+
+
+def fetch_paths_for_groups(conn, group_ids_query, args={}):
+    """Returns a dict mapping every group id selected by @group_ids_query to
+    a list of hash strings for the group and its ancestors, that joined
+    together can form a relative path to the group dir"""
     query = '''
-        SELECT id, created
+        SELECT id, path
           FROM "group"
-         WHERE id = (SELECT parent_id
-                       FROM %s
-                      WHERE id = :id)'''
+         WHERE id IN (%s)''' % group_ids_query
 
     cursor = conn.cursor()
-    parents = []
-    res = cursor.execute(query % 'text', {"id": text_id}).fetchone()
-    while res:
-        # parent strings are hashes of their creation date
-        parents.append(hash_for_creation_datetime(res[1]))
-        res = cursor.execute(query % '"group"', {"id": res[0]}).fetchone()
+    paths = {}
+    for group_id, path in cursor.execute(query, args):
+        paths[group_id] = path.split('/')
 
-    parents.reverse()
-    return parents
+    return paths
 
 
-def fetch_texts(conn, where='', order='', args={}):
-    """Return an iterator of texts from the db, satisfying optional
-    constraints"""
+def fetch_tags_for_texts(conn, text_ids_query, args={}):
+    """Returns a dict mapping every text id selected by @text_ids_query, that
+    has been tagged, to the list of its tags; the tag strings are interned, so
+    that the texts with the same tag hold the same string"""
+    query = '''
+        SELECT text_id, tag_keyword
+          FROM text_tags
+         WHERE text_id IN (%s)''' % text_ids_query
+
+    cursor = conn.cursor()
+    tags = {}
+    for text_id, keyword in cursor.execute(query, args):
+        tags.setdefault(text_id, []).append(sys.intern(keyword))
+
+    return tags
+
+
+def fetch_texts(conn, where='', order='', args={}, limit=None):
+    """Return an iterator of TextRecords from the db, satisfying optional
+    constraints, upto @limit texts if given"""
+    selection = '\n  FROM text'
+    if where:
+        selection += '\nWHERE %s' % where
+    if order:
+        selection += '\nORDER BY %s' % order
+    if limit is not None:
+        selection += '\nLIMIT %d' % limit
+
+    # look up parents and tags for all selected texts at once, rather than
+    # querying for each text separately
+    paths = fetch_paths_for_groups(conn, 'SELECT parent_id' + selection, args)
+    tags = fetch_tags_for_texts(conn, 'SELECT id' + selection, args)
+
     query = '''
         SELECT id
              , title
@@ -281,38 +646,78 @@ def fetch_texts(conn, where='', order='', args={}):
              , subtitle
              , word_goal
              , last_edit_position
-          FROM text'''
-    if where:
-        query += '\nWHERE %s' % where
-    if order:
-        query += '\nORDER BY %s' % order
+             , hash_id''' + selection
+
+    # texts in the same group share the tuple of its parents
+    paths = {group_id: tuple(path) for group_id, path in paths.items()}
+    tags = {text_id: tuple(labels) for text_id, labels in tags.items()}
 
     cursor = conn.cursor()
     for row in cursor.execute(query, args):
-        values = {
-            'id': row[0],
-            'title': row[1],
-            'created': row[2],
-            'last_modified': row[3],
-            'parent_id': row[4],
-            'in_trash': row[5],
-            'markup': row[6],
-            'subtitle': row[7],
-            'word_goal': row[8],
-            'last_edit_position': row[9]
-        }
-
-        # create hash_id for text; hope they are not created at the same time
-        # on milliseconds scale!
-        values['hash_id'] = hash_for_creation_datetime(values['created'])
-
-        # create a list of parents
-        values['parents'] = fetch_parents_for_text(conn, values['id'])
-
-        # obtain a list of tags
-        values['tags'] = fetch_tags_for_text(conn, values['id'])
-
-        yield values
+        id, parent_id, markup = row[0], row[4], row[6]
+        if markup is not None:
+            markup = sys.intern(markup)
+
+        yield TextRecord._make((id, row[1], row[2], row[3], parent_id, row[5],
+                                markup, row[7], row[8], row[9], row[10],
+                                paths.get(parent_id, ()), tags.get(id, ())))
+
+
+# columns that texts can be paged through in order of, and whether the order
+# is descending, i.e. latest modified or alphabetically first texts come first
+page_orders = {
+    'last_modified': True,
+    'title': False
+}
+
+
+def fetch_texts_page(conn, where='', args={}, order_by='last_modified',
+                     cursor=None, page_size=100):
+    """Return a list of at most @page_size texts satisfying optional
+    constraints, ordered by the @order_by column (one of `page_orders`) and
+    then id, along with a cursor to the next page, or None if this is the last
+    page. Pass @cursor as returned for the previous page to get the next one.
+
+    Pages are found by looking for texts past the last one on the previous
+    page, rather than by offset, so fetching a page takes as long no matter
+    how far down the list it is."""
+    descending = page_orders[order_by]
+    page_args = dict(args)
+    conditions = []
+    if where:
+        conditions.append('(%s)' % where)
+    if cursor is not None:
+        # written so that the first comparison can be used to seek an index
+        comparison = '<' if descending else '>'
+        conditions.append('''{column} {cmp}= :cursor_value
+                           AND ({column} {cmp} :cursor_value
+                                OR id {cmp} :cursor_id)'''.format(
+            column=order_by, cmp=comparison))
+        page_args['cursor_value'], page_args['cursor_id'] = cursor
+
+    direction = 'DESC' if descending else 'ASC'
+    order = '{column} {direction}, id {direction}'.format(column=order_by,
+                                                           direction=direction)
+
+    # fetch one extra text to know if there is a next page at all
+    texts = list(fetch_texts(conn, ' AND '.join(conditions), order,
+                             page_args, limit=page_size + 1))
+    next_cursor = None
+    if len(texts) > page_size:
+        texts.pop()
+        last_text = texts[-1]
+        next_cursor = (last_text[order_by], last_text['id'])
+
+    return texts, next_cursor
+
+
+def count_texts_matching(conn, where='', args={}):
+    """Return the number of texts satisfying optional constraints"""
+    query = 'SELECT COUNT(*) FROM text'
+    if where:
+        query += '\nWHERE %s' % where
+    cursor = conn.cursor()
+    return cursor.execute(query, args).fetchone()[0]
 
 
 def texts_not_in_groups(conn):
@@ -329,9 +734,37 @@ def texts_in_group(conn, group_id):
 
 
 def text_for_id(conn, text_id):
-    """Return the text for given db id"""
-    where_condition = 'id = :id'
-    args = {"id": text_id}
+    """Return the text for given db id; it may come from the metadata cache"""
+    def load_text():
+        where_condition = 'id = :id'
+        args = {"id": text_id}
+        gen = fetch_texts(conn, where_condition, args=args)
+        return next(gen)
+
+    return db.metadata_cache.get('text', text_id, load_text)
+
+
+def texts_for_ids(conn, text_ids):
+    """Return an iterator of texts for the given list of db ids"""
+    where_condition = 'id IN (%s)' % ', '.join(str(int(i)) for i in text_ids)
+    return fetch_texts(conn, where_condition)
+
+
+def last_modified_for_texts(conn, text_ids):
+    """Return a dict mapping each of the given text ids, if it exists in db,
+    to its last modified date-time string"""
+    query = '''
+        SELECT id, last_modified
+          FROM text
+         WHERE id IN (%s)''' % ', '.join(str(int(i)) for i in text_ids)
+    cursor = conn.cursor()
+    return dict(cursor.execute(query).fetchall())
+
+
+def text_for_hash_id(conn, hash_id):
+    """Return the text whose contents are stored in the file named @hash_id"""
+    where_condition = 'hash_id = :hash_id'
+    args = {"hash_id": hash_id}
     gen = fetch_texts(conn, where_condition, args=args)
     return next(gen)
 
@@ -373,46 +806,29 @@ def texts_in_trash_but_not_parent(conn):
 
 def count_texts_in_trash_but_not_parent(conn):
     """Returns the count of texts that are in trash but their parents are not"""
-    query = '''
-        SELECT COUNT(id)
-          FROM text
-         WHERE id IN (SELECT id
-                       FROM text
-                      WHERE in_trash = 1
-                        AND parent_id IN (SELECT id
-                                            FROM "group"
-                                           WHERE in_trash = 0))
-    '''
-    cursor = conn.cursor()
-    res = cursor.execute(query)
-    return res.fetchone()[0]
+    return stat_for_group(conn, None, 'trashed_orphans')
 
 
 def fetch_parents_for_group(conn, group_id):
     """Returns a list of hash strings for parent groups that joined
     together can form a relative path to group dir"""
-    query = '''
-        SELECT id, created
-          FROM "group"
-         WHERE id = (SELECT parent_id
-                       FROM "group"
-                      WHERE id = :id)'''
-
-    cursor = conn.cursor()
-    parents = []
-    res = cursor.execute(query, {"id": group_id}).fetchone()
-    while res:
-        # parent strings are hashes of their creation date
-        parents.append(hash_for_creation_datetime(res[1]))
-        res = cursor.execute(query, {"id": res[0]}).fetchone()
-
-    parents.reverse()
-    return parents
+    query = 'SELECT parent_id FROM "group" WHERE id = :id'
+    paths = fetch_paths_for_groups(conn, query, {"id": group_id})
+    return paths.get(group_id, [])
 
 
 def fetch_groups(conn, where='', order='', args={}):
     """Return an iterator of text groups from the db, satisfying optional
     constraints"""
+    where_clause = ''
+    if where:
+        where_clause = '\nWHERE %s' % where
+
+    # look up parents for all selected groups at once
+    paths = fetch_paths_for_groups(conn,
+                                   'SELECT parent_id FROM "group"' + where_clause,
+                                   args)
+
     query = '''
         SELECT id
              , name
@@ -420,9 +836,8 @@ def fetch_groups(conn, where='', order='', args={}):
              , last_modified
              , parent_id
              , in_trash
-          FROM "group"'''
-    if where:
-        query += '\nWHERE %s' % where
+             , hash_id
+          FROM "group"''' + where_clause
     if order:
         query += '\nORDER BY %s' % order
 
@@ -434,14 +849,12 @@ def fetch_groups(conn, where='', order='', args={}):
             'created': row[2],
             'last_modified': row[3],
             'parent_id': row[4],
-            'in_trash': row[5]
+            'in_trash': row[5],
+            'hash_id': row[6]
         }
 
-        # create hash_id for group
-        values['hash_id'] = hash_for_creation_datetime(values['created'])
-
         # create a list of parents
-        values['parents'] = fetch_parents_for_group(conn, values['id'])
+        values['parents'] = list(paths.get(values['parent_id'], []))
 
         yield values
 
@@ -460,9 +873,22 @@ def groups_in_group(conn, group_id):
 
 
 def group_for_id(conn, group_id):
-    """Return the group for given db id"""
-    where_condition = 'id = :id'
-    args = {"id": group_id}
+    """Return the group for given db id; it may come from the metadata cache,
+    so a copy is returned that can be changed freely"""
+    def load_group():
+        where_condition = 'id = :id'
+        args = {"id": group_id}
+        gen = fetch_groups(conn, where_condition, args=args)
+        return next(gen)
+
+    group = db.metadata_cache.get('group', group_id, load_group)
+    return dict(group, parents=list(group['parents']))
+
+
+def group_for_hash_id(conn, hash_id):
+    """Return the group whose texts are stored in the dir named @hash_id"""
+    where_condition = 'hash_id = :hash_id'
+    args = {"hash_id": hash_id}
     gen = fetch_groups(conn, where_condition, args=args)
     return next(gen)
 
@@ -490,7 +916,7 @@ def fetch_tags(conn, where_condition='', order_condition='', args={}):
     if where_condition:
         query += '\nWHERE %s' % where_condition
     if order_condition:
-        query += '\nORDER BY' % order_condition
+        query += '\nORDER BY %s' % order_condition
 
     cursor = conn.cursor()
     for row in cursor.execute(query, args):
@@ -505,11 +931,9 @@ def tags_with_at_least_one_text(conn):
     """Return an iterator of tags that are tagged to at least one text item that
     is not in trash."""
     where_condition = '''
-        keyword in (SELECT tag_keyword
-                      FROM text_tags
-                     WHERE text_id IN (SELECT id
-                                         FROM text
-                                        WHERE in_trash = 0))
+        keyword IN (SELECT tag_keyword
+                      FROM tag_stats
+                     WHERE texts > 0)
     '''
     return fetch_tags(conn, where_condition=where_condition)
 
@@ -522,70 +946,156 @@ def tag_with_label(conn, label):
     return next(gen)
 
 
-def count_texts_with_tag(conn, label):
-    """Return a count of the number of texts tagged with given label"""
+def fetch_tag_statistics(conn):
+    """Return an iterator of `TagStats` for all tags, ordered by keyword,
+    counted in a single query"""
     query = '''
-        SELECT COUNT(text_id)
-          FROM text_tags
-         WHERE tag_keyword = :label
-           AND text_id IN (SELECT id
-                             FROM text
-                            WHERE in_trash = 0)
-    '''
+          SELECT tag.keyword,
+                 count(CASE WHEN text.in_trash = 0 THEN 1 END),
+                 count(CASE WHEN text.in_trash = 1 THEN 1 END),
+                 max(CASE WHEN text.in_trash = 0 THEN text.last_modified END)
+            FROM tag
+                 LEFT JOIN text_tags
+                        ON text_tags.tag_keyword = tag.keyword
+                 LEFT JOIN text
+                        ON text.id = text_tags.text_id
+        GROUP BY tag.keyword
+        ORDER BY tag.keyword'''
     cursor = conn.cursor()
-    res = cursor.execute(query, {'label': label})
-    return res.fetchone()[0]
+    for row in cursor.execute(query):
+        yield TagStats(*row)
 
 
-def count_texts(conn, group_id=None, in_trash=False):
-    """Return the number of texts in the given @group, that are not trashed"""
-    base_query = '''
-        SELECT COUNT(id)
-          FROM text
-    '''
+def tag_statistics(conn):
+    """Return a read-only dict of all tag keywords mapped to their `TagStats`.
+    The dict is cached until tags are changed, or texts are trashed or
+    restored, so it is cheaper to look up many tags in it than to count texts
+    for each of them. Other changes to texts change no counts, so they keep
+    the dict, though `last_used` may then lag behind them."""
+    def load_statistics():
+        return MappingProxyType({stats.keyword: stats
+                                 for stats in fetch_tag_statistics(conn)})
+
+    return db.metadata_cache.get('tags', None, load_statistics)
+
+
+def count_texts_with_tag(conn, label):
+    """Return a count of the number of texts, that are not in trash, tagged
+    with given label"""
+    stats = tag_statistics(conn).get(label)
+    return stats.texts if stats else 0
+
 
-    if group_id is None:
-        where_clause = '''
-            WHERE parent_id IS NULL
-              AND in_trash = :in_trash
-        '''
-        cursor = conn.cursor()
-        values = {'in_trash': in_trash}
-        res = cursor.execute(base_query + where_clause, values)
-        return res.fetchone()[0]
-    else:
-        where_clause = '''
-             WHERE parent_id = :group_id
-               AND in_trash = :in_trash
-        '''
-        cursor = conn.cursor()
-        values = {'group_id': group_id, 'in_trash': in_trash}
-        res = cursor.execute(base_query + where_clause, values)
-        return res.fetchone()[0]
+def count_texts(conn, group_id=None, in_trash=False):
+    """Return the number of texts in the given @group, that are trashed or not
+    as given by @in_trash"""
+    column = 'trashed_texts' if in_trash else 'texts'
+    return stat_for_group(conn, group_id, column)
 
 
 def count_groups(conn, group_id=None, in_trash=False):
-    """Return the number of groups in the given @group, that are not trashed"""
-    base_query = '''
-        SELECT COUNT(id)
-          FROM "group"
-    '''
+    """Return the number of groups in the given @group, that are trashed or not
+    as given by @in_trash"""
+    column = 'trashed_subgroups' if in_trash else 'subgroups'
+    return stat_for_group(conn, group_id, column)
+
 
-    if group_id is None:
-        where_clause = '''
-            WHERE parent_id IS NULL
-              AND in_trash = :in_trash
-        '''
-        cursor = conn.cursor()
-        values = {'in_trash': in_trash}
-        res = cursor.execute(base_query + where_clause, values)
-        return res.fetchone()[0]
-    else:
-        where_clause = '''
-             WHERE parent_id = :group_id
-               AND in_trash = :in_trash
-        '''
-        cursor = conn.cursor()
-        values = {'group_id': group_id, 'in_trash': in_trash}
-        res = cursor.execute(base_query + where_clause, values)
-        return res.fetchone()[0]
+def stat_for_group(conn, group_id, column):
+    """Look up @column of the counts kept for @group_id (or the top level if
+    it is None), which are maintained by triggers on the text and group
+    tables"""
+    query = '''
+        SELECT %s
+          FROM group_stats
+         WHERE group_id = :group_id''' % column
+    cursor = conn.cursor()
+    res = cursor.execute(query, {'group_id': group_id or 0}).fetchone()
+    return res[0] if res else 0
+
+
+# queries computing, from scratch, the counts kept in group_stats and tag_stats
+live_group_stats_query = '''
+    SELECT group_id, SUM(texts), SUM(trashed_texts), SUM(subgroups),
+           SUM(trashed_subgroups), SUM(trashed_orphans)
+      FROM (SELECT COALESCE(parent_id, 0) AS group_id,
+                   in_trash = 0 AS texts,
+                   in_trash = 1 AS trashed_texts,
+                   0 AS subgroups,
+                   0 AS trashed_subgroups,
+                   0 AS trashed_orphans
+              FROM text
+             UNION ALL
+            SELECT COALESCE(parent_id, 0), 0, 0, in_trash = 0, in_trash = 1, 0
+              FROM "group"
+             UNION ALL
+            SELECT id, 0, 0, 0, 0, 0
+              FROM "group"
+             UNION ALL
+            SELECT 0, 0, 0, 0, 0, COUNT(*)
+              FROM text
+             WHERE in_trash = 1
+               AND parent_id IN (SELECT id FROM "group" WHERE in_trash = 0))
+  GROUP BY group_id'''
+
+live_tag_stats_query = '''
+    SELECT tag.keyword, COUNT(text.id), COUNT(text_tags.text_id)
+      FROM tag
+           LEFT JOIN text_tags
+                  ON text_tags.tag_keyword = tag.keyword
+           LEFT JOIN text
+                  ON text.id = text_tags.text_id
+                 AND text.in_trash = 0
+  GROUP BY tag.keyword'''
+
+
+def verify_stats(conn, repair=False):
+    """Compare the counts kept in group_stats and tag_stats against counts
+    computed afresh from the text, group and tag tables. Returns a dict with
+    the keys 'groups' and 'tags', each mapping the group id or tag keyword
+    whose counts differ to a tuple of (kept counts, actual counts). If @repair
+    is True and any counts differ, they are all rebuilt."""
+    cursor = conn.cursor()
+
+    def nonzero_rows(query):
+        return {row[0]: tuple(row[1:])
+                for row in cursor.execute(query)
+                if any(row[1:])}
+
+    def diff(kept_query, live_query):
+        kept = nonzero_rows(kept_query)
+        live = nonzero_rows(live_query)
+        differences = {}
+        for key in set(kept) | set(live):
+            if kept.get(key) != live.get(key):
+                differences[key] = (kept.get(key), live.get(key))
+        return differences
+
+    differences = {
+        'groups': diff('''
+            SELECT group_id, texts, trashed_texts, subgroups,
+                   trashed_subgroups, trashed_orphans
+              FROM group_stats''', live_group_stats_query),
+        'tags': diff('''
+            SELECT tag_keyword, texts, refs
+              FROM tag_stats''', live_tag_stats_query)
+    }
+
+    if repair and (differences['groups'] or differences['tags']):
+        rebuild_stats(conn)
+
+    return differences
+
+
+def rebuild_stats(conn):
+    """Recompute all counts in group_stats and tag_stats from scratch"""
+    cursor = conn.cursor()
+    with db.transaction(conn):
+        cursor.execute('DELETE FROM group_stats')
+        cursor.execute('''
+            INSERT INTO group_stats (group_id, texts, trashed_texts, subgroups,
+                                     trashed_subgroups, trashed_orphans)
+        ''' + live_group_stats_query)
+        cursor.execute('DELETE FROM tag_stats')
+        cursor.execute('''
+            INSERT INTO tag_stats (tag_keyword, texts, refs)
+        ''' + live_tag_stats_query)
@@ -0,0 +1,93 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class Journal(object):
+    """An append-only file of changes made to the contents of a RequestQueue,
+    so that items still pending in queue can be recovered after the app quits
+    or crashes. Each line is a JSON object: ``{"key": k, "value": v}`` when an
+    item is enqueued, or ``{"key": k}`` when it is removed from queue."""
+
+    # keys of the values that are not worth saving, e.g. search highlights
+    ignored_fields = ['misc']
+
+    def __init__(self, url):
+        self.url = url
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _write(self, entry):
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.url, 'a', encoding='utf-8')
+            self._file.write(line)
+            # leave it to the OS to write to disk, which it will even if the
+            # app gets killed
+            self._file.flush()
+
+    def append(self, key, value):
+        """Record that @value was enqueued with @key"""
+        value = {k: v for k, v in value.items()
+                 if k not in self.ignored_fields}
+        self._write({'key': key, 'value': value})
+
+    def remove(self, key):
+        """Record that the item with @key is no longer pending"""
+        self._write({'key': key})
+
+    def replay(self):
+        """Return an OrderedDict of the items still pending according to the
+        journal, in the order they were enqueued"""
+        items = OrderedDict()
+        if not os.path.exists(self.url):
+            return items
+
+        with open(self.url, encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                    key = entry['key']
+                except (ValueError, KeyError, TypeError):
+                    # most likely the last line, cut short by a crash
+                    continue
+
+                items.pop(key, None)
+                if 'value' in entry:
+                    items[key] = entry['value']
+
+        return items
+
+    def truncate(self):
+        """Forget all recorded changes, once they have been applied"""
+        with self._lock:
+            self._close_file()
+            if os.path.exists(self.url):
+                os.remove(self.url)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        """Close the journal file, it is reopened if written to again"""
+        with self._lock:
+            self._close_file()
@@ -0,0 +1,125 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+
+class Maintenance(object):
+    """Keeps the db in shape over time, with work small enough to be done in
+    steps while the app is otherwise idle.
+
+    Once @analyze_after rows have been inserted or deleted since the planner
+    statistics were last gathered, the next step runs `ANALYZE`, looking at
+    about @analysis_limit rows of each index so that the step stays short
+    however large the db grows. Other steps
+    give up to @vacuum_pages free pages back to the file system with
+    `PRAGMA incremental_vacuum`, which needs the db to be in incremental
+    `auto_vacuum` mode. Page counts are recorded before and after each run
+    of steps, to see how much was reclaimed."""
+
+    def __init__(self, vacuum_pages=256, analyze_after=1000,
+                 analysis_limit=400):
+        self.vacuum_pages = vacuum_pages
+        self.analyze_after = analyze_after
+        self.analysis_limit = analysis_limit
+
+        # counters, mostly useful while debugging
+        self.analyses = 0
+        self.analyze_time = 0.0
+        self.vacuum_steps = 0
+        self.pages_freed = 0
+        # page counts of the db when the current or last run of vacuum steps
+        # started and after its latest step
+        self.pages_before = None
+        self.pages_after = None
+
+        self._changed_rows = 0
+        self._lock = threading.Lock()
+
+    def note_changes(self, num_rows):
+        """Count @num_rows inserted or deleted rows towards the next
+        `ANALYZE`"""
+        with self._lock:
+            self._changed_rows += num_rows
+
+    def analyze_due(self):
+        """Whether enough rows have changed to gather statistics again"""
+        return self._changed_rows >= self.analyze_after
+
+    def page_counts(self, conn):
+        """Return a dict with the 'page_size', the number of pages in all as
+        'pages' and the number of unused pages as 'free_pages' in the db"""
+        cursor = conn.cursor()
+        return {
+            'page_size': cursor.execute('PRAGMA page_size').fetchone()[0],
+            'pages': cursor.execute('PRAGMA page_count').fetchone()[0],
+            'free_pages': cursor.execute('PRAGMA freelist_count').fetchone()[0]
+        }
+
+    def optimize(self, conn):
+        """Let sqlite gather whatever statistics the queries run on @conn
+        could have used, meant to be done just before it is closed"""
+        conn.execute('PRAGMA analysis_limit = %d' % self.analysis_limit)
+        conn.execute('PRAGMA optimize')
+
+    def analyze(self, conn):
+        """Gather statistics about all tables and indexes for the planner"""
+        started = time.perf_counter()
+        conn.execute('PRAGMA analysis_limit = %d' % self.analysis_limit)
+        conn.execute('ANALYZE')
+        with self._lock:
+            self._changed_rows = 0
+            self.analyses += 1
+            self.analyze_time += time.perf_counter() - started
+
+    def step(self, conn):
+        """Do one piece of due maintenance on @conn, which must not be in a
+        transaction. Returns True if there is more to do."""
+        if self.analyze_due():
+            self.analyze(conn)
+            return True
+
+        cursor = conn.cursor()
+        if cursor.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # only incremental mode keeps free pages around to be reclaimed
+            return False
+
+        counts = self.page_counts(conn)
+        if not counts['free_pages']:
+            return False
+
+        if self.pages_after is None or self.pages_after != counts:
+            self.pages_before = counts
+        # `execute` steps through the pragma just once, which frees a single
+        # page, while `executescript` runs it to the end
+        conn.executescript('PRAGMA incremental_vacuum(%d)'
+                           % self.vacuum_pages)
+        self.pages_after = self.page_counts(conn)
+        self.vacuum_steps += 1
+        self.pages_freed += counts['pages'] - self.pages_after['pages']
+        return self.pages_after['free_pages'] > 0
+
+    def stats(self):
+        """Return a dict of counters describing maintenance done so far"""
+        return {
+            'analyses': self.analyses,
+            'analyze_time': self.analyze_time,
+            'changed_rows': self._changed_rows,
+            'vacuum_steps': self.vacuum_steps,
+            'pages_freed': self.pages_freed,
+            'pages_before': self.pages_before,
+            'pages_after': self.pages_after
+        }
@@ -13,12 +13,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import re
+import sqlite3
+
 from draftsrc import db
+from draftsrc.db import data
 
 # A dict for storing db versions corresponding to the application version they
 # were meant to be used with; this should be updated every new realease.
 db_versions = {
-    '0.1.0': 1,
+    '0.1.0': 8,
 }
 
 # The 'up' script, for a version X, allows migration from version X to the next
@@ -125,9 +129,9 @@ migration_scripts = {
                 FOREIGN KEY(parent_id) REFERENCES notebook (id)
             );
 
-            INSERT INTO 'group' (id, name, created, last_modified, parent_id, in_trash)
+            INSERT INTO notebook (id, name, created, last_modified, parent_id, in_trash)
                  SELECT id, name, created, last_modified, parent_id, in_trash
-                   FROM notebook;
+                   FROM 'group';
 
             DROP TABLE 'group';
 
@@ -166,6 +170,557 @@ migration_scripts = {
             /* set version */
             PRAGMA user_version = 0;
             '''
+    },
+    1: {
+        'up': '''
+            /* store the path of each group, as hashes of its ancestors and
+               itself joined by "/", so that parents of a text or group can
+               be found without walking up the tree */
+            ALTER TABLE "group"
+              ADD COLUMN path TEXT DEFAULT NULL;
+
+            WITH RECURSIVE paths (id, path) AS (
+                    SELECT id, sha256(created)
+                      FROM "group"
+                     WHERE parent_id IS NULL
+                        OR parent_id NOT IN (SELECT id FROM "group")
+                 UNION ALL
+                    SELECT child.id, paths.path || '/' || sha256(child.created)
+                      FROM "group" AS child
+                      JOIN paths ON child.parent_id = paths.id)
+            UPDATE "group"
+               SET path = (SELECT path
+                             FROM paths
+                            WHERE paths.id = "group".id);
+
+            CREATE INDEX group_path ON "group" (path);
+
+            /* set version */
+            PRAGMA user_version = 2;
+            ''',
+
+        'down': '''
+            /* drop the group path column */
+            DROP INDEX group_path;
+
+            CREATE TABLE group2 (
+                id            INTEGER NOT NULL DEFAULT NULL PRIMARY KEY,
+                name          TEXT    NOT NULL DEFAULT NULL,
+                created       TEXT    NOT NULL DEFAULT NULL,
+                last_modified TEXT    NOT NULL DEFAULT NULL,
+                parent_id     INTEGER          DEFAULT NULL REFERENCES "group" (id),
+                in_trash      INTEGER NOT NULL DEFAULT 0
+            );
+
+            INSERT INTO group2 (id, name, created, last_modified, parent_id, in_trash)
+                 SELECT id, name, created, last_modified, parent_id, in_trash
+                   FROM "group";
+
+            DROP TABLE "group";
+
+            ALTER TABLE group2
+              RENAME TO "group";
+
+            /* set version */
+            PRAGMA user_version = 1;
+            '''
+    },
+    2: {
+        'up': '''
+            /* store the hash of creation date, used as name for the file or
+               dir of a text or group, instead of computing it on every read */
+            ALTER TABLE text
+              ADD COLUMN hash_id TEXT DEFAULT NULL;
+
+            UPDATE text
+               SET hash_id = sha256(created);
+
+            CREATE UNIQUE INDEX text_hash_id ON text (hash_id);
+
+            ALTER TABLE "group"
+              ADD COLUMN hash_id TEXT DEFAULT NULL;
+
+            UPDATE "group"
+               SET hash_id = sha256(created);
+
+            CREATE UNIQUE INDEX group_hash_id ON "group" (hash_id);
+
+            /* set version */
+            PRAGMA user_version = 3;
+            ''',
+
+        'down': '''
+            /* drop the hash_id columns */
+            DROP INDEX text_hash_id;
+            DROP INDEX group_hash_id;
+            DROP INDEX group_path;
+
+            CREATE TABLE text2 (
+                id                 INTEGER NOT NULL DEFAULT NULL PRIMARY KEY,
+                title              TEXT    NOT NULL DEFAULT NULL,
+                created            TEXT    NOT NULL DEFAULT NULL,
+                last_modified      TEXT    NOT NULL DEFAULT NULL,
+                parent_id          INTEGER          DEFAULT NULL REFERENCES "group" (id),
+                in_trash           INTEGER NOT NULL DEFAULT 0,
+                markup             TEXT             DEFAULT NULL,
+                subtitle           TEXT             DEFAULT NULL,
+                word_goal          INTEGER          DEFAULT NULL,
+                last_edit_position INTEGER          DEFAULT NULL
+            );
+
+            INSERT INTO text2 (id, title, created, last_modified, parent_id,
+                               in_trash, markup, subtitle, word_goal,
+                               last_edit_position)
+                 SELECT id, title, created, last_modified, parent_id,
+                        in_trash, markup, subtitle, word_goal,
+                        last_edit_position
+                   FROM text;
+
+            DROP TABLE text;
+
+            ALTER TABLE text2
+              RENAME TO text;
+
+            CREATE TABLE group2 (
+                id            INTEGER NOT NULL DEFAULT NULL PRIMARY KEY,
+                name          TEXT    NOT NULL DEFAULT NULL,
+                created       TEXT    NOT NULL DEFAULT NULL,
+                last_modified TEXT    NOT NULL DEFAULT NULL,
+                parent_id     INTEGER          DEFAULT NULL REFERENCES "group" (id),
+                in_trash      INTEGER NOT NULL DEFAULT 0,
+                path          TEXT             DEFAULT NULL
+            );
+
+            INSERT INTO group2 (id, name, created, last_modified, parent_id,
+                                in_trash, path)
+                 SELECT id, name, created, last_modified, parent_id,
+                        in_trash, path
+                   FROM "group";
+
+            DROP TABLE "group";
+
+            ALTER TABLE group2
+              RENAME TO "group";
+
+            CREATE INDEX group_path ON "group" (path);
+
+            /* set version */
+            PRAGMA user_version = 2;
+            '''
+    },
+    3: {
+        'up': '''
+            /* indexes for looking up texts and groups by parent or trash
+               status, texts by modification date, and texts by tag */
+            CREATE INDEX text_parent_id ON text (parent_id, in_trash);
+            CREATE INDEX text_in_trash ON text (in_trash, last_modified);
+            CREATE INDEX text_last_modified ON text (last_modified);
+            CREATE INDEX group_parent_id ON "group" (parent_id, in_trash);
+            CREATE INDEX group_in_trash ON "group" (in_trash);
+            CREATE INDEX text_tags_tag_keyword ON text_tags (tag_keyword, text_id);
+
+            /* set version */
+            PRAGMA user_version = 4;
+            ''',
+
+        'down': '''
+            DROP INDEX text_parent_id;
+            DROP INDEX text_in_trash;
+            DROP INDEX text_last_modified;
+            DROP INDEX group_parent_id;
+            DROP INDEX group_in_trash;
+            DROP INDEX text_tags_tag_keyword;
+
+            /* set version */
+            PRAGMA user_version = 3;
+            '''
+    },
+    4: {
+        'up': '''
+            /* index for paging through texts ordered by title */
+            CREATE INDEX text_in_trash_title ON text (in_trash, title);
+
+            /* set version */
+            PRAGMA user_version = 5;
+            ''',
+
+        'down': '''
+            DROP INDEX text_in_trash_title;
+
+            /* set version */
+            PRAGMA user_version = 4;
+            '''
+    },
+    5: {
+        'up': '''
+            /* number of texts and groups, trashed or not, directly within
+               each group; the texts and groups at top level are counted under
+               group id 0. For the top level only, `trashed_orphans` is the
+               number of trashed texts whose parent group is not trashed. */
+            CREATE TABLE group_stats (
+                group_id          INTEGER NOT NULL PRIMARY KEY,
+                texts             INTEGER NOT NULL DEFAULT 0,
+                trashed_texts     INTEGER NOT NULL DEFAULT 0,
+                subgroups         INTEGER NOT NULL DEFAULT 0,
+                trashed_subgroups INTEGER NOT NULL DEFAULT 0,
+                trashed_orphans   INTEGER NOT NULL DEFAULT 0
+            );
+
+            /* number of texts, that are not trashed, tagged with each tag */
+            CREATE TABLE tag_stats (
+                tag_keyword TEXT    NOT NULL PRIMARY KEY,
+                texts       INTEGER NOT NULL DEFAULT 0
+            );
+
+            INSERT INTO group_stats (group_id, texts, trashed_texts,
+                                     subgroups, trashed_subgroups)
+                 SELECT group_id, SUM(texts), SUM(trashed_texts),
+                        SUM(subgroups), SUM(trashed_subgroups)
+                   FROM (SELECT COALESCE(parent_id, 0) AS group_id,
+                                in_trash = 0 AS texts,
+                                in_trash = 1 AS trashed_texts,
+                                0 AS subgroups,
+                                0 AS trashed_subgroups
+                           FROM text
+                          UNION ALL
+                         SELECT COALESCE(parent_id, 0), 0, 0, in_trash = 0,
+                                in_trash = 1
+                           FROM "group"
+                          UNION ALL
+                         SELECT id, 0, 0, 0, 0
+                           FROM "group"
+                          UNION ALL
+                         SELECT 0, 0, 0, 0, 0)
+               GROUP BY group_id;
+
+            UPDATE group_stats
+               SET trashed_orphans = (SELECT COUNT(*)
+                                        FROM text
+                                       WHERE in_trash = 1
+                                         AND parent_id IN (SELECT id
+                                                             FROM "group"
+                                                            WHERE in_trash = 0))
+             WHERE group_id = 0;
+
+            INSERT INTO tag_stats (tag_keyword, texts)
+                 SELECT tag.keyword, COUNT(text.id)
+                   FROM tag
+                        LEFT JOIN text_tags
+                               ON text_tags.tag_keyword = tag.keyword
+                        LEFT JOIN text
+                               ON text.id = text_tags.text_id
+                              AND text.in_trash = 0
+               GROUP BY tag.keyword;
+
+            /* keep the counts up to date as texts change */
+            CREATE TRIGGER text_stats_insert AFTER INSERT ON text
+            BEGIN
+                INSERT OR IGNORE INTO group_stats (group_id)
+                     VALUES (COALESCE(NEW.parent_id, 0));
+                UPDATE group_stats
+                   SET texts = texts + (NEW.in_trash = 0),
+                       trashed_texts = trashed_texts + (NEW.in_trash = 1)
+                 WHERE group_id = COALESCE(NEW.parent_id, 0);
+                UPDATE group_stats
+                   SET trashed_orphans = trashed_orphans + 1
+                 WHERE group_id = 0
+                   AND NEW.in_trash = 1
+                   AND EXISTS (SELECT 1 FROM "group"
+                                WHERE id = NEW.parent_id AND in_trash = 0);
+            END;
+
+            CREATE TRIGGER text_stats_delete AFTER DELETE ON text
+            BEGIN
+                UPDATE group_stats
+                   SET texts = texts - (OLD.in_trash = 0),
+                       trashed_texts = trashed_texts - (OLD.in_trash = 1)
+                 WHERE group_id = COALESCE(OLD.parent_id, 0);
+                UPDATE group_stats
+                   SET trashed_orphans = trashed_orphans - 1
+                 WHERE group_id = 0
+                   AND OLD.in_trash = 1
+                   AND EXISTS (SELECT 1 FROM "group"
+                                WHERE id = OLD.parent_id AND in_trash = 0);
+                UPDATE tag_stats
+                   SET texts = texts - 1
+                 WHERE OLD.in_trash = 0
+                   AND tag_keyword IN (SELECT tag_keyword FROM text_tags
+                                        WHERE text_id = OLD.id);
+            END;
+
+            CREATE TRIGGER text_stats_update
+             AFTER UPDATE OF parent_id, in_trash ON text
+              WHEN OLD.parent_id IS NOT NEW.parent_id
+                OR OLD.in_trash IS NOT NEW.in_trash
+            BEGIN
+                UPDATE group_stats
+                   SET texts = texts - (OLD.in_trash = 0),
+                       trashed_texts = trashed_texts - (OLD.in_trash = 1)
+                 WHERE group_id = COALESCE(OLD.parent_id, 0);
+                INSERT OR IGNORE INTO group_stats (group_id)
+                     VALUES (COALESCE(NEW.parent_id, 0));
+                UPDATE group_stats
+                   SET texts = texts + (NEW.in_trash = 0),
+                       trashed_texts = trashed_texts + (NEW.in_trash = 1)
+                 WHERE group_id = COALESCE(NEW.parent_id, 0);
+                UPDATE group_stats
+                   SET trashed_orphans = trashed_orphans
+                       - (OLD.in_trash = 1
+                          AND EXISTS (SELECT 1 FROM "group"
+                                       WHERE id = OLD.parent_id
+                                         AND in_trash = 0))
+                       + (NEW.in_trash = 1
+                          AND EXISTS (SELECT 1 FROM "group"
+                                       WHERE id = NEW.parent_id
+                                         AND in_trash = 0))
+                 WHERE group_id = 0;
+                UPDATE tag_stats
+                   SET texts = texts - (OLD.in_trash = 0) + (NEW.in_trash = 0)
+                 WHERE tag_keyword IN (SELECT tag_keyword FROM text_tags
+                                        WHERE text_id = NEW.id);
+            END;
+
+            /* ... as subgroups change */
+            CREATE TRIGGER group_stats_insert AFTER INSERT ON "group"
+            BEGIN
+                INSERT OR IGNORE INTO group_stats (group_id) VALUES (NEW.id);
+                INSERT OR IGNORE INTO group_stats (group_id)
+                     VALUES (COALESCE(NEW.parent_id, 0));
+                UPDATE group_stats
+                   SET subgroups = subgroups + (NEW.in_trash = 0),
+                       trashed_subgroups = trashed_subgroups + (NEW.in_trash = 1)
+                 WHERE group_id = COALESCE(NEW.parent_id, 0);
+                UPDATE group_stats
+                   SET trashed_orphans = trashed_orphans
+                       + (SELECT trashed_texts FROM group_stats
+                           WHERE group_id = NEW.id)
+                 WHERE group_id = 0
+                   AND NEW.in_trash = 0;
+            END;
+
+            CREATE TRIGGER group_stats_delete AFTER DELETE ON "group"
+            BEGIN
+                UPDATE group_stats
+                   SET trashed_orphans = trashed_orphans
+                       - IFNULL((SELECT trashed_texts FROM group_stats
+                                  WHERE group_id = OLD.id), 0)
+                 WHERE group_id = 0
+                   AND OLD.in_trash = 0;
+                UPDATE group_stats
+                   SET subgroups = subgroups - (OLD.in_trash = 0),
+                       trashed_subgroups = trashed_subgroups - (OLD.in_trash = 1)
+                 WHERE group_id = COALESCE(OLD.parent_id, 0);
+                DELETE FROM group_stats
+                 WHERE group_id = OLD.id
+                   AND texts = 0 AND trashed_texts = 0
+                   AND subgroups = 0 AND trashed_subgroups = 0;
+            END;
+
+            CREATE TRIGGER group_stats_update
+             AFTER UPDATE OF parent_id, in_trash ON "group"
+              WHEN OLD.parent_id IS NOT NEW.parent_id
+                OR OLD.in_trash IS NOT NEW.in_trash
+            BEGIN
+                UPDATE group_stats
+                   SET subgroups = subgroups - (OLD.in_trash = 0),
+                       trashed_subgroups = trashed_subgroups - (OLD.in_trash = 1)
+                 WHERE group_id = COALESCE(OLD.parent_id, 0);
+                INSERT OR IGNORE INTO group_stats (group_id)
+                     VALUES (COALESCE(NEW.parent_id, 0));
+                UPDATE group_stats
+                   SET subgroups = subgroups + (NEW.in_trash = 0),
+                       trashed_subgroups = trashed_subgroups + (NEW.in_trash = 1)
+                 WHERE group_id = COALESCE(NEW.parent_id, 0);
+                UPDATE group_stats
+                   SET trashed_orphans = trashed_orphans
+                       + ((NEW.in_trash = 0) - (OLD.in_trash = 0))
+                         * IFNULL((SELECT trashed_texts FROM group_stats
+                                    WHERE group_id = NEW.id), 0)
+                 WHERE group_id = 0;
+            END;
+
+            /* ... and as tags change */
+            CREATE TRIGGER tag_stats_insert AFTER INSERT ON tag
+            BEGIN
+                INSERT OR IGNORE INTO tag_stats (tag_keyword)
+                     VALUES (NEW.keyword);
+            END;
+
+            CREATE TRIGGER tag_stats_delete AFTER DELETE ON tag
+            BEGIN
+                DELETE FROM tag_stats WHERE tag_keyword = OLD.keyword;
+            END;
+
+            CREATE TRIGGER tag_stats_update AFTER UPDATE OF keyword ON tag
+            BEGIN
+                UPDATE tag_stats
+                   SET tag_keyword = NEW.keyword
+                 WHERE tag_keyword = OLD.keyword;
+            END;
+
+            CREATE TRIGGER text_tags_stats_insert AFTER INSERT ON text_tags
+            BEGIN
+                INSERT OR IGNORE INTO tag_stats (tag_keyword)
+                     VALUES (NEW.tag_keyword);
+                UPDATE tag_stats
+                   SET texts = texts + 1
+                 WHERE tag_keyword = NEW.tag_keyword
+                   AND EXISTS (SELECT 1 FROM text
+                                WHERE id = NEW.text_id AND in_trash = 0);
+            END;
+
+            CREATE TRIGGER text_tags_stats_delete AFTER DELETE ON text_tags
+            BEGIN
+                UPDATE tag_stats
+                   SET texts = texts - 1
+                 WHERE tag_keyword = OLD.tag_keyword
+                   AND EXISTS (SELECT 1 FROM text
+                                WHERE id = OLD.text_id AND in_trash = 0);
+            END;
+
+            CREATE TRIGGER text_tags_stats_update AFTER UPDATE ON text_tags
+            BEGIN
+                UPDATE tag_stats
+                   SET texts = texts - 1
+                 WHERE tag_keyword = OLD.tag_keyword
+                   AND EXISTS (SELECT 1 FROM text
+                                WHERE id = OLD.text_id AND in_trash = 0);
+                INSERT OR IGNORE INTO tag_stats (tag_keyword)
+                     VALUES (NEW.tag_keyword);
+                UPDATE tag_stats
+                   SET texts = texts + 1
+                 WHERE tag_keyword = NEW.tag_keyword
+                   AND EXISTS (SELECT 1 FROM text
+                                WHERE id = NEW.text_id AND in_trash = 0);
+            END;
+
+            /* set version */
+            PRAGMA user_version = 6;
+            ''',
+
+        'down': '''
+            DROP TRIGGER text_stats_insert;
+            DROP TRIGGER text_stats_delete;
+            DROP TRIGGER text_stats_update;
+            DROP TRIGGER group_stats_insert;
+            DROP TRIGGER group_stats_delete;
+            DROP TRIGGER group_stats_update;
+            DROP TRIGGER tag_stats_insert;
+            DROP TRIGGER tag_stats_delete;
+            DROP TRIGGER tag_stats_update;
+            DROP TRIGGER text_tags_stats_insert;
+            DROP TRIGGER text_tags_stats_delete;
+            DROP TRIGGER text_tags_stats_update;
+            DROP TABLE group_stats;
+            DROP TABLE tag_stats;
+
+            /* set version */
+            PRAGMA user_version = 5;
+            '''
+    },
+    6: {
+        'up': '''
+            /* number of texts tagged with each tag, trashed or not. A tag is
+               deleted as soon as no text is tagged with it any more. */
+            ALTER TABLE tag_stats
+              ADD COLUMN refs INTEGER NOT NULL DEFAULT 0;
+
+            DELETE FROM tag
+                  WHERE keyword NOT IN (SELECT tag_keyword
+                                          FROM text_tags);
+
+            UPDATE tag_stats
+               SET refs = (SELECT COUNT(*)
+                             FROM text_tags
+                            WHERE tag_keyword = tag_stats.tag_keyword);
+
+            CREATE TRIGGER text_tags_refs_insert AFTER INSERT ON text_tags
+            BEGIN
+                INSERT OR IGNORE INTO tag_stats (tag_keyword)
+                     VALUES (NEW.tag_keyword);
+                UPDATE tag_stats
+                   SET refs = refs + 1
+                 WHERE tag_keyword = NEW.tag_keyword;
+            END;
+
+            CREATE TRIGGER text_tags_refs_delete AFTER DELETE ON text_tags
+            BEGIN
+                UPDATE tag_stats
+                   SET refs = refs - 1
+                 WHERE tag_keyword = OLD.tag_keyword;
+                DELETE FROM tag
+                 WHERE keyword = OLD.tag_keyword
+                   AND (SELECT refs FROM tag_stats
+                         WHERE tag_keyword = OLD.tag_keyword) = 0;
+            END;
+
+            CREATE TRIGGER text_tags_refs_update
+             AFTER UPDATE OF tag_keyword ON text_tags
+              WHEN OLD.tag_keyword IS NOT NEW.tag_keyword
+            BEGIN
+                INSERT OR IGNORE INTO tag_stats (tag_keyword)
+                     VALUES (NEW.tag_keyword);
+                UPDATE tag_stats
+                   SET refs = refs + 1
+                 WHERE tag_keyword = NEW.tag_keyword;
+                UPDATE tag_stats
+                   SET refs = refs - 1
+                 WHERE tag_keyword = OLD.tag_keyword;
+                DELETE FROM tag
+                 WHERE keyword = OLD.tag_keyword
+                   AND (SELECT refs FROM tag_stats
+                         WHERE tag_keyword = OLD.tag_keyword) = 0;
+            END;
+
+            /* set version */
+            PRAGMA user_version = 7;
+            ''',
+
+        'down': '''
+            DROP TRIGGER text_tags_refs_insert;
+            DROP TRIGGER text_tags_refs_delete;
+            DROP TRIGGER text_tags_refs_update;
+
+            /* triggers on other tables refer to tag_stats, so they must not
+               be checked while it is being replaced */
+            PRAGMA legacy_alter_table = ON;
+
+            CREATE TABLE tag_stats2 (
+                tag_keyword TEXT    NOT NULL PRIMARY KEY,
+                texts       INTEGER NOT NULL DEFAULT 0
+            );
+
+            INSERT INTO tag_stats2 (tag_keyword, texts)
+                 SELECT tag_keyword, texts
+                   FROM tag_stats;
+
+            DROP TABLE tag_stats;
+
+            ALTER TABLE tag_stats2
+              RENAME TO tag_stats;
+
+            PRAGMA legacy_alter_table = OFF;
+
+            /* set version */
+            PRAGMA user_version = 6;
+            '''
+    },
+    7: {
+        'up': '''
+            /* let free pages be given back to the file system a few at a
+               time, rather than only by rebuilding the whole db */
+            PRAGMA auto_vacuum = INCREMENTAL;
+
+            /* set version */
+            PRAGMA user_version = 8;
+            ''',
+
+        'down': '''
+            PRAGMA auto_vacuum = NONE;
+
+            /* set version */
+            PRAGMA user_version = 7;
+            '''
     }
 }
 
@@ -177,27 +732,241 @@ migration_scripts = {
 # a script that understands all the different db versions.
 
 
+def statements_in_script(script):
+    """Split @script into the SQL statements it is made of, so that they can be
+    executed one at a time. Semicolons within trigger bodies do not end a
+    statement."""
+    statements = []
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ''
+    if statement.strip():
+        statements.append(statement.strip())
+    return statements
+
+
+def _without_comments(statement):
+    return re.sub(r'/\*.*?\*/', '', statement, flags=re.DOTALL).strip()
+
+
+# number of rows copied at once by statements that copy a whole table
+copy_batch_size = 5000
+
+# a statement copying all rows of a table into another one, i.e. `INSERT INTO
+# new (...) SELECT ... FROM old` with nothing after the name of the old table
+copy_statement = re.compile(r"""
+    ^INSERT \s+ INTO \s+ (?P<target> "\w+" | '\w+' | \w+ ) \s* \( [^)]* \) \s*
+    SELECT \s .+ \s FROM \s+ (?P<source> "\w+" | '\w+' | \w+ ) \s* ;? $
+""", re.IGNORECASE | re.DOTALL | re.VERBOSE)
+
+
+class MigrationRunner(object):
+    """Runs the migration scripts on @conn, from the current version of the db
+    up or down to @desired_db_version, one step after another.
+
+    Each step is committed once it is done, along with the new db version.
+    Statements copying a whole table are run in batches of @batch_size rows,
+    each batch committed on its own, and the number of rows copied is checked
+    against the table copied from, which is kept until then. How far the
+    current step has got is kept in the `migration_state` table, so that an
+    interrupted migration resumes from there when it is run again.
+
+    @progress_fn, if given, is called with the number of steps done and the
+    number of steps in all, followed by the number of rows copied so far and
+    in all by the current copy, or zeros between copies."""
+
+    def __init__(self, conn, desired_db_version, batch_size=copy_batch_size,
+                 progress_fn=None):
+        self.conn = conn
+        self.desired_db_version = desired_db_version
+        self.batch_size = batch_size
+        self.progress_fn = progress_fn
+
+        self._steps_done = 0
+        self._steps = 0
+
+    def _version(self):
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def _report(self, copied=0, total=0):
+        if self.progress_fn:
+            self.progress_fn(self._steps_done, self._steps, copied, total)
+
+    def _load_state(self):
+        """Return the (version, action, statement, last_rowid) at which a
+        previous run was interrupted, or None"""
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS migration_state (
+                version    INTEGER NOT NULL,
+                action     TEXT    NOT NULL,
+                statement  INTEGER NOT NULL,
+                last_rowid INTEGER NOT NULL DEFAULT 0
+            )''')
+        return self.conn.execute('''
+            SELECT version, action, statement, last_rowid
+              FROM migration_state''').fetchone()
+
+    def _save_state(self, version, action, statement, last_rowid=0):
+        """Record that the step from @version has been done up to the
+        statement at index @statement; committed with the current
+        transaction"""
+        self.conn.execute('DELETE FROM migration_state')
+        self.conn.execute('''
+            INSERT INTO migration_state (version, action, statement,
+                                         last_rowid)
+                 VALUES (?, ?, ?, ?)''', (version, action, statement,
+                                             last_rowid))
+
+    def run(self):
+        """Run all steps needed, resuming an interrupted run if there was one.
+        Raises an exception if a step fails, leaving the steps done so far
+        and the rows copied so far by the failed step committed."""
+        cursor = self.conn.cursor()
+        current_db_version = self._version()
+
+        # default action is to upgrade scehma
+        action = 'up'
+        key_offset = 0
+        if self.desired_db_version < current_db_version:
+            action = 'down'
+            key_offset = 1
+
+        state = self._load_state()
+        start = 0
+        last_rowid = 0
+        if state and state[0] == current_db_version and state[1] == action:
+            start, last_rowid = state[2], state[3]
+
+        self._steps = abs(self.desired_db_version - current_db_version)
+        rebuild = False
+        while current_db_version != self.desired_db_version:
+            # the correct key for migration_scripts
+            scriptkey = current_db_version - key_offset
+            script = migration_scripts[scriptkey][action]
+            if self._run_step(script, current_db_version, action, start,
+                              last_rowid):
+                rebuild = True
+            start = 0
+            last_rowid = 0
+
+            current_db_version = self._version()
+            self._steps_done += 1
+            self._report()
+            # TODO (notify): db migration step successful
+
+        cursor.execute('DROP TABLE migration_state')
+
+        # a new `auto_vacuum` mode only takes effect once the whole db is
+        # rebuilt, which cannot be done within a transaction
+        if rebuild:
+            cursor.execute('VACUUM')
+
+    def _run_step(self, script, version, action, start, last_rowid):
+        """Run the statements of @script, the step from @version, skipping
+        those before the one at index @start, which, if it is a copy, goes on
+        after the row with @last_rowid. Returns True if the step changes
+        `auto_vacuum`."""
+        cursor = self.conn.cursor()
+        rebuild = False
+        cursor.execute('BEGIN')
+        try:
+            for index, statement in enumerate(statements_in_script(script)):
+                sql = _without_comments(statement)
+                is_pragma = re.match(r'PRAGMA\s+(\w+)', sql, re.IGNORECASE)
+                if is_pragma and is_pragma.group(1).lower() == 'auto_vacuum':
+                    rebuild = True
+
+                if index < start:
+                    # done before the last run was interrupted, except that
+                    # settings for the connection have to be made again
+                    if (is_pragma
+                            and is_pragma.group(1).lower() != 'user_version'):
+                        cursor.execute(sql)
+                    continue
+
+                match = copy_statement.match(sql)
+                if match is None:
+                    cursor.execute(sql)
+                    continue
+
+                if index != start:
+                    last_rowid = 0
+                # what was done so far is kept, whatever happens to the copy
+                self._save_state(version, action, index, last_rowid)
+                cursor.execute('COMMIT')
+                self._copy(sql, match.group('source'), match.group('target'),
+                           last_rowid)
+                cursor.execute('BEGIN')
+                self._save_state(version, action, index + 1)
+
+            self._save_state(self._version(), action, 0)
+            cursor.execute('COMMIT')
+        except Exception as e:
+            if self.conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            raise e
+
+        return rebuild
+
+    def _copy(self, sql, source, target, last_rowid):
+        """Run @sql, which copies all rows of the @source table into the
+        @target table, in batches, starting after the row with @last_rowid,
+        which was copied before the last run was interrupted"""
+        cursor = self.conn.cursor()
+        total = cursor.execute('SELECT COUNT(*) FROM %s' % source).fetchone()[0]
+        copied = cursor.execute('SELECT COUNT(*) FROM %s' % target).fetchone()[0]
+        self._report(copied, total)
+
+        batch_query = sql.rstrip(';') + '''
+                  WHERE rowid > :after
+                    AND rowid <= :upto'''
+        upto_query = '''
+            SELECT MAX(rowid)
+              FROM (SELECT rowid
+                      FROM %s
+                     WHERE rowid > :after
+                  ORDER BY rowid
+                     LIMIT :limit)''' % source
+        while True:
+            args = {'after': last_rowid, 'limit': self.batch_size}
+            upto = cursor.execute(upto_query, args).fetchone()[0]
+            if upto is None:
+                break
+
+            cursor.execute('BEGIN')
+            try:
+                cursor.execute(batch_query, {'after': last_rowid,
+                                             'upto': upto})
+                copied += cursor.rowcount
+                cursor.execute('''
+                    UPDATE migration_state
+                       SET last_rowid = ?''', (upto,))
+                cursor.execute('COMMIT')
+            except Exception as e:
+                cursor.execute('ROLLBACK')
+                raise e
+
+            last_rowid = upto
+            self._report(copied, total)
+
+        copied = cursor.execute('SELECT COUNT(*) FROM %s' % target).fetchone()[0]
+        if copied != total:
+            raise sqlite3.IntegrityError('%d of %d rows copied from %s to %s'
+                                         % (copied, total, source, target))
+
+
 # Only upgrades will reliably work at the moment!
-def migrate_db(desired_version):
+def migrate_db(desired_version, progress_fn=None):
     """Updates db scehma to match the version that can be used by
     @desired_version of the application; arg value is the version of the
-    application, not db version."""
-    desired_db_version = db_versions[desired_version]
-    current_db_version = db.version()
-
-    # default action is to upgrade scehma
-    action = 'up'
-    key_offset = 0
-    if desired_db_version < current_db_version:
-        action = 'down'
-        key_offset = 1
-
-    while current_db_version != desired_db_version:
-        # the correct key for migration_scripts
-        scriptkey = current_db_version - key_offset
-        with db.connect() as conn:
-            cursor = conn.cursor()
-            cursor.executescript(migration_scripts[scriptkey][action])
-
-        current_db_version = db.version()
-        # TODO (notify): db migration step successful
+    application, not db version. Steps are made by a `MigrationRunner`, which
+    calls @progress_fn, if given, as they go; see there for its arguments."""
+    with db.connect() as conn:
+        # scripts may need to hash creation dates, like the data layer
+        conn.create_function('sha256', 1, data.hash_for_creation_datetime)
+        runner = MigrationRunner(conn, db_versions[desired_version],
+                                 copy_batch_size, progress_fn)
+        runner.run()
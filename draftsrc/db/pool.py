@@ -0,0 +1,195 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ConnectionPool(object):
+    """Keeps sqlite connections to the db open between uses. There is a single
+    long-lived writer connection, which one thread at a time may hold, and up
+    to @size reader connections that are handed out for read-only work and
+    closed once they have been idle for @idle_timeout seconds. Every new
+    connection is set up with the PRAGMA name-value pairs in @pragmas."""
+
+    def __init__(self, url, size=4, idle_timeout=60, pragmas=None):
+        self.url = url
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.pragmas = pragmas if pragmas is not None else {}
+
+        # counters, mostly useful while debugging
+        self.checkouts = 0
+        self.wait_time = 0.0
+
+        # callables run each time the outermost scope lending the writer ends
+        self.writer_release_hooks = []
+        # callables run with every new connection, once it is set up
+        self.open_hooks = []
+
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._idle_readers = []
+        self._num_readers = 0
+        # readers lent out at the moment, and those of them that are to be
+        # closed rather than kept once returned, see `close`
+        self._lent_readers = set()
+        self._retired_readers = set()
+        self._readers_available = threading.Condition()
+        self._local = threading.local()
+
+    def _open(self):
+        """Open a new connection to the db"""
+        connection = sqlite3.connect(self.url, check_same_thread=False)
+        connection.isolation_level = None
+        for name, value in self.pragmas.items():
+            connection.execute('PRAGMA %s = %s' % (name, value))
+        for hook in self.open_hooks:
+            hook(connection)
+        return connection
+
+    def _record_checkout(self, waiting_since):
+        self.checkouts += 1
+        self.wait_time += time.monotonic() - waiting_since
+
+    @contextmanager
+    def writer(self, blocking=True):
+        """Lend the writer connection to the calling thread. Scopes may be
+        nested within one thread. The connection is in autocommit mode, so
+        every statement is committed as it runs unless grouped with
+        `db.transaction`; only a transaction still left open when the
+        outermost scope exits is committed there, or rolled back if the scope
+        raised. If @blocking is False and another thread holds the writer,
+        None is lent instead of waiting for it."""
+        waiting_since = time.monotonic()
+        if not self._writer_lock.acquire(blocking):
+            yield None
+            return
+
+        try:
+            self._record_checkout(waiting_since)
+            if self._writer is None:
+                self._writer = self._open()
+
+            depth = getattr(self._local, 'writer_depth', 0)
+            self._local.writer_depth = depth + 1
+            try:
+                yield self._writer
+                if not depth:
+                    self._writer.commit()
+            except Exception as e:
+                if not depth:
+                    self._writer.rollback()
+                raise e
+            finally:
+                self._local.writer_depth = depth
+                if not depth:
+                    for hook in self.writer_release_hooks:
+                        hook()
+        finally:
+            self._writer_lock.release()
+
+    @contextmanager
+    def reader(self):
+        """Lend a reader connection to the calling thread. Nested scopes in
+        the same thread share the connection of the outermost one."""
+        connection = getattr(self._local, 'reader', None)
+        if connection is not None:
+            yield connection
+            return
+
+        waiting_since = time.monotonic()
+        connection = self._checkout_reader()
+        self._record_checkout(waiting_since)
+        self._local.reader = connection
+        try:
+            yield connection
+        finally:
+            self._local.reader = None
+            self._checkin_reader(connection)
+
+    def _checkout_reader(self):
+        with self._readers_available:
+            while True:
+                self._close_idle_readers()
+                if self._idle_readers:
+                    connection, last_used = self._idle_readers.pop()
+                    self._lent_readers.add(connection)
+                    return connection
+                if self._num_readers < self.size:
+                    self._num_readers += 1
+                    break
+                self._readers_available.wait()
+
+        try:
+            connection = self._open()
+            with self._readers_available:
+                self._lent_readers.add(connection)
+            return connection
+        except Exception as e:
+            with self._readers_available:
+                self._num_readers -= 1
+                self._readers_available.notify()
+            raise e
+
+    def _checkin_reader(self, connection):
+        with self._readers_available:
+            self._lent_readers.discard(connection)
+            if connection in self._retired_readers:
+                self._retired_readers.remove(connection)
+                self._num_readers -= 1
+                connection.close()
+            else:
+                self._idle_readers.append((connection, time.monotonic()))
+            self._close_idle_readers()
+            self._readers_available.notify()
+
+    def _close_idle_readers(self):
+        """Close readers that have not been used for a while; must be called
+        with `_readers_available` held"""
+        now = time.monotonic()
+        for item in list(self._idle_readers):
+            connection, last_used = item
+            if now - last_used > self.idle_timeout:
+                self._idle_readers.remove(item)
+                self._num_readers -= 1
+                connection.close()
+
+    def stats(self):
+        """Return a dict of counters describing pool usage so far"""
+        return {
+            'checkouts': self.checkouts,
+            'wait_time': self.wait_time,
+            'readers_open': self._num_readers,
+            'readers_idle': len(self._idle_readers),
+        }
+
+    def close(self):
+        """Close the writer and any idle readers, e.g. when the app quits or
+        connections have to be set up anew. Readers lent out at the moment are
+        closed once they are returned, instead of being reused."""
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+        with self._readers_available:
+            for connection, last_used in self._idle_readers:
+                connection.close()
+            self._num_readers -= len(self._idle_readers)
+            self._idle_readers = []
+            self._retired_readers.update(self._lent_readers)
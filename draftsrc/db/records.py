@@ -0,0 +1,67 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+
+text_fields = ('id', 'title', 'created', 'last_modified', 'parent_id',
+               'in_trash', 'markup', 'subtitle', 'word_goal',
+               'last_edit_position', 'hash_id', 'parents', 'tags')
+
+
+class TextRecord(namedtuple('TextRecord', text_fields)):
+    """Read-only metadata of a text, as fetched from db. Values can be read
+    either as attributes or by key, like from a dict, though iterating over
+    a record gives its values, as with any tuple. The `parents` and `tags`
+    are tuples, that may be shared with other records, so a copy should be
+    made (e.g. with `to_dict`) of any values that need to be changed."""
+
+    __slots__ = ()
+
+    # values are looked up by name, or by position or slice as tuple items
+    _indexes = {name: index for index, name in enumerate(text_fields)}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._indexes[key]
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __repr__(self):
+        return '<TextRecord id=%r title=%r>' % (self.id, self.title)
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return self[key]
+        return default
+
+    def keys(self):
+        return self._fields
+
+    def to_dict(self):
+        """Return a new dict of the values, with lists in place of tuples"""
+        values = self._asdict()
+        values['parents'] = list(self.parents)
+        values['tags'] = list(self.tags)
+        return values
+
+
+# Usage of a tag, as counted over the texts tagged with it. `texts` counts
+# texts that are not in trash and `trashed_texts` those that are, while
+# `last_used` is the latest `last_modified` of the former, or None if there
+# are none.
+TagStats = namedtuple('TagStats', ['keyword', 'texts', 'trashed_texts',
+                                   'last_used'])
@@ -13,92 +13,386 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 import threading
+import time
 from collections import OrderedDict
 
 from draftsrc import db
 
+logger = logging.getLogger(__name__)
 
-class RequestQueue(OrderedDict):
-    """A dict with queue like FIFO methods, and supports asynchronous work
-    to be done with the items contained within."""
-    active = False
 
-    def __init__(self, async=True, immediate_activation=True):
-        super().__init__()
-        self.async = async
+class RequestQueue(object):
+    """A thread-safe dict with queue like FIFO methods, and supports
+    asynchronous work to be done with the items contained within. Work for
+    a threaded queue is done by a long-lived worker thread, which sleeps
+    while there is nothing to do. If a `journal` is set, every change to the
+    contents of queue is also recorded in it."""
+    journal = None
+
+    def __init__(self, threaded=True, immediate_activation=True, max_size=0):
+        """Initialize an empty queue
+
+        :param threaded: Whether work is done in a separate worker thread, or
+                         in the thread calling ``activate``
+        :param immediate_activation: Whether work should start as soon as an
+                                     item is enqueued
+        :param max_size: If non-zero, ``enqueue`` blocks while the queue has
+                         this many items, until the worker catches up
+        """
+        self.threaded = threaded
         self.immediate_activation = immediate_activation
+        self.max_size = max_size
+        self.active = False
+
+        self._items = OrderedDict()
+        self._enqueue_times = {}
+        self._condition = threading.Condition()
+        self._worker = None
+        self._work_requested = False
+        self._closing = False
+
+        # counters, mostly useful while debugging
+        self.max_depth = 0
+        self.num_dequeued = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def __len__(self):
+        with self._condition:
+            return len(self._items)
+
+    def __contains__(self, key):
+        with self._condition:
+            return key in self._items
 
     def enqueue(self, key, val):
-        """Put an item in queue with a unique key. If the queue was empty and
-        should immeadiately be working on the requests, activate it."""
-        self[key] = val
-        if not self.active and self.immediate_activation:
+        """Put an item in queue with a unique key. If the queue should
+        immeadiately be working on the requests, wake up the worker."""
+        with self._condition:
+            if self._can_wait_for_worker():
+                while (len(self._items) >= self.max_size
+                       and key not in self._items):
+                    self._request_work()
+                    self._condition.wait()
+
+            if key not in self._items:
+                self._enqueue_times[key] = time.monotonic()
+            self._items[key] = val
+            if self.journal is not None:
+                self.journal.append(key, val)
+            self.max_depth = max(self.max_depth, len(self._items))
+
+            if self.immediate_activation and self.threaded:
+                self._request_work()
+
+        if self.immediate_activation and not self.threaded:
             self.activate()
 
+    def _can_wait_for_worker(self):
+        """Whether a full queue can be waited upon to make room for more"""
+        return (self.max_size
+                and self.threaded
+                and not self._closing
+                and threading.current_thread() is not self._worker)
+
     def remove_if_exists(self, key):
         """Remove the item with given key if it exists"""
-        if key in self:
-            self.pop(key)
+        with self._condition:
+            if key in self._items:
+                self._items.pop(key)
+                self._enqueue_times.pop(key, None)
+                if self.journal is not None:
+                    self.journal.remove(key)
+                self._condition.notify_all()
+
+    def replace_if_exists(self, key, value):
+        """Replace the value of the item with given key, keeping its place in
+        queue, if it exists. Returns whether it did."""
+        with self._condition:
+            if key not in self._items:
+                return False
+            self._items[key] = value
+            if self.journal is not None:
+                self.journal.append(key, value)
+            return True
 
     def activate(self):
-        """Work on the contents of the queue, in a separate thread."""
+        """Work on the contents of the queue, in the worker thread if the
+        queue is threaded, otherwise right away."""
+        if self.threaded:
+            with self._condition:
+                self._request_work()
+            return
+
         self.active = True
-        if self.async:
-            thread = threading.Thread(target=self.do_work)
-            thread.daemon = True
-            thread.start()
-        else:
+        try:
             self.do_work()
+        finally:
+            self.active = False
+
+    def _request_work(self):
+        """Wake up the worker, starting it first if needed; must be called
+        with `_condition` held"""
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run)
+            self._worker.daemon = True
+            self._worker.start()
+
+        self._work_requested = True
+        self._condition.notify_all()
+
+    def _run(self):
+        """Main loop of the worker thread"""
+        try:
+            while True:
+                with self._condition:
+                    while not self._work_requested:
+                        if self._closing:
+                            return
+                        self._condition.wait()
+                    self._work_requested = False
+                    self.active = True
+
+                try:
+                    self.do_work()
+                except Exception:
+                    # the worker has to go on, or nothing queued from now on
+                    # would ever be written
+                    logger.exception('Work on %r failed', self)
+                finally:
+                    with self._condition:
+                        self.active = False
+                        self._condition.notify_all()
+        finally:
+            with self._condition:
+                if self._worker is threading.current_thread():
+                    self._worker = None
+
+    def drain(self):
+        """Work on the contents of the queue and wait for all of it to be
+        done."""
+        if not self.threaded:
+            self.activate()
+            return
+
+        with self._condition:
+            self._request_work()
+            while self._work_requested or self.active:
+                self._condition.wait()
+
+    def close(self):
+        """Finish work on remaining items, e.g. when the app quits, and stop
+        the worker."""
+        if self.threaded and self._worker is not None:
+            self.drain()
+            with self._condition:
+                self._closing = True
+                self._condition.notify_all()
+            self._worker.join()
+            self._worker = None
+        elif len(self):
+            self.activate()
 
     def dequeue(self):
         """Get the oldest item inserted into the queue."""
         key, val = None, None
-        if len(self):
-            key, val = self.popitem(last=False)
+        with self._condition:
+            if self._items:
+                key, val = self._items.popitem(last=False)
+                latency = time.monotonic() - self._enqueue_times.pop(key)
+                self.num_dequeued += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                # there might be someone waiting for room in queue
+                self._condition.notify_all()
 
         return key, val
 
+    def discard(self, key):
+        """Give up on an item taken out of queue whose work failed, so that
+        it is not recovered from the journal either, unless a newer value has
+        been enqueued for it meanwhile"""
+        with self._condition:
+            if self.journal is not None and key not in self._items:
+                self.journal.remove(key)
+
+    def stats(self):
+        """Return a dict of counters describing the queue depth and the time
+        items spent waiting in the queue"""
+        average_latency = 0.0
+        if self.num_dequeued:
+            average_latency = self.total_latency / self.num_dequeued
+
+        return {
+            'depth': len(self),
+            'max_depth': self.max_depth,
+            'dequeued': self.num_dequeued,
+            'average_latency': average_latency,
+            'max_latency': self.max_latency
+        }
+
     def do_work(self):
         """Defines what should be done with the items in queue. This method
         must be defined by subclasses accordingly."""
-        self.active = False
+        pass
 
 
 class UpdateRequestQueue(RequestQueue):
-    """A RequestQueue meant for performing updates to the database."""
+    """A RequestQueue meant for performing updates to the database. Pending
+    updates are drained in batches of at most `batch_size` items, each batch
+    being applied in one transaction. The items of a batch that fails are
+    applied one at a time, and those that fail again are dropped."""
     execution_fn = None
     fetch_fn = None
+    batch_size = 200
+
+    def __init__(self, threaded=True, immediate_activation=True, max_size=0):
+        super().__init__(threaded, immediate_activation, max_size)
+        self.num_batches = 0
+        self.num_flushed = 0
+        self.total_flush_latency = 0.0
+        self.last_flush_latency = 0.0
+
+    def dequeue_batch(self):
+        """Get upto `batch_size` of the oldest items in the queue, as a dict"""
+        batch = OrderedDict()
+        while len(batch) < self.batch_size:
+            id, values = self.dequeue()
+            if not (id and values):
+                break
+            batch[id] = values
+
+        return batch
 
     def do_work(self):
-        """Loop over the queue and for each item perform `execution_fn`
-        operation."""
+        """Drain the queue in batches and perform `execution_fn` on each batch.
+        If `fetch_fn` is defined, it is used to find current last modified
+        date-times of the items in the batch, and items that are older than
+        what is already in db, or no longer exist, are skipped."""
         if self.execution_fn is None:
-            self.active = False
             return
 
         while True:
-            id, values = self.dequeue()
-            if not (id and values):
+            batch = self.dequeue_batch()
+            if not batch:
                 break
 
+            started = time.monotonic()
+            try:
+                with db.connect() as connection:
+                    # a batch is applied in a single transaction, so if any
+                    # of this fails, none of it has been written
+                    self.drop_outdated(connection, batch)
+                    if batch:
+                        self.execution_fn(connection, batch)
+            except Exception:
+                # TODO (notify): some sqlite exception; the updates are tried
+                # once more one by one, so that a single bad update can not
+                # hold up all the others
+                logger.exception('Updates for %d texts failed', len(batch))
+                for id, values in batch.items():
+                    self.apply_one(id, values)
+                continue
+
+            self._record_flush(len(batch), time.monotonic() - started)
+
+    def apply_one(self, id, values):
+        """Perform `execution_fn` for a single item in a transaction of its
+        own, e.g. after the batch it was in failed. If this fails as well,
+        the item is dropped."""
+        item = OrderedDict([(id, values)])
+        try:
             with db.connect() as connection:
-                if self.fetch_fn:
-                    try:
-                        current_values = self.fetch_fn(connection, id)
-                        last_modified = db.get_datetime_from_string(current_values['last_modified'])
-                        new_last_modified = db.get_datetime_from_string(values['last_modified'])
-                        if last_modified > new_last_modified:
-                            continue
-                    except Exception as e:
-                         # (notify): maybe text with given id does not exist,
-                         # or some other sqlite exception; regardless it is
-                         # unsafe to proceed with update execution -- skip this.
-                         continue
-
-                self.execution_fn(connection, id, values)
+                self.drop_outdated(connection, item)
+                if item:
+                    self.execution_fn(connection, item)
+        except Exception:
+            # TODO (notify): the update is lost
+            logger.exception('Update for text %r failed, dropping it', id)
+            self.discard(id)
 
-        self.active = False
+    def drop_outdated(self, conn, batch):
+        """Remove the items from @batch that are older than what is already in
+        db, or no longer exist, as found with `fetch_fn` if it is defined"""
+        if not self.fetch_fn:
+            return
+
+        current_last_modified = self.fetch_fn(conn, list(batch))
+        for id in list(batch):
+            if id not in current_last_modified:
+                batch.pop(id)
+                continue
+            last_modified = db.get_datetime_from_string(current_last_modified[id])
+            new_last_modified = db.get_datetime_from_string(batch[id]['last_modified'])
+            if last_modified > new_last_modified:
+                batch.pop(id)
+
+    def _record_flush(self, num_items, latency):
+        self.num_batches += 1
+        self.num_flushed += num_items
+        self.total_flush_latency += latency
+        self.last_flush_latency = latency
+
+    def stats(self):
+        """Return a dict of counters describing the queue and the batches
+        flushed so far"""
+        stats = super().stats()
+        average_batch_size = 0
+        average_flush_latency = 0.0
+        if self.num_batches:
+            average_batch_size = self.num_flushed / self.num_batches
+            average_flush_latency = self.total_flush_latency / self.num_batches
+
+        stats.update({
+            'batches': self.num_batches,
+            'items': self.num_flushed,
+            'average_batch_size': average_batch_size,
+            'average_flush_latency': average_flush_latency,
+            'last_flush_latency': self.last_flush_latency
+        })
+        return stats
+
+
+class TimedUpdateRequestQueue(UpdateRequestQueue):
+    """An UpdateRequestQueue for low priority updates, which are accumulated
+    and written every `period` seconds, or as soon as `max_pending` items are
+    waiting in queue, whichever comes first."""
+
+    def __init__(self, period=180, max_pending=50):
+        super().__init__(immediate_activation=False)
+        self.period = period
+        self.max_pending = max_pending
+        self._timer = None
+
+    def enqueue(self, key, val):
+        """Put an item in queue with a unique key. Flush the queue if it has
+        grown large enough, otherwise make sure a flush has been scheduled."""
+        super().enqueue(key, val)
+        if len(self) >= self.max_pending:
+            self.flush()
+            return
+
+        # the timer is also reset by flushes from the timer thread
+        with self._condition:
+            if self._timer is None:
+                self._timer = threading.Timer(self.period, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self, wait=False):
+        """Write out pending updates in the worker thread, and if @wait is
+        True, e.g. when the app is quitting, wait for them to be written."""
+        with self._condition:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if wait:
+            self.drain()
+        else:
+            self.activate()
 
 
 class DeleteRequestQueue(RequestQueue):
@@ -109,7 +403,6 @@ class DeleteRequestQueue(RequestQueue):
         """Loop over the queue and perform `deletion_fn` for each of the
         items"""
         if self.deletion_fn is None:
-            self.active = False
             return
 
         while True:
@@ -117,7 +410,11 @@ class DeleteRequestQueue(RequestQueue):
             if id is None:
                 break
 
-            with db.connect() as connection:
-                self.deletion_fn(connection, id)
-
-        self.active = False
+            try:
+                with db.connect() as connection:
+                    self.deletion_fn(connection, id)
+            except Exception:
+                # TODO (notify): some sqlite exception; the deletion is lost,
+                # but the ones after it are still made
+                logger.exception('Deletion of %r failed, dropping it', id)
+                self.discard(id)
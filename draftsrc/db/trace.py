@@ -0,0 +1,308 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+import inspect
+import math
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+
+def _percentile(samples, fraction):
+    """Return the nearest-rank percentile of @samples, or 0 if empty"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def normalize_statement(sql):
+    """Return @sql with literal values replaced by '?', so that executions of
+    the same statement with different parameters are counted together"""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    # parameters bound to None, but not e.g. `IS NULL`
+    sql = re.sub(r'([=,(]\s*)NULL\b', r'\1?', sql)
+    sql = re.sub(r'\s+', ' ', sql).strip()
+    # lists of ids, e.g. in `id IN (...)`, vary in length
+    return re.sub(r'\(\?(?: ?, ?\?)+\)', '(?, ...)', sql)
+
+
+class _Stats(object):
+    """Counters for either a function or a statement"""
+
+    __slots__ = ['count', 'total', 'rows', 'statements', 'durations']
+
+    def __init__(self, samples_kept):
+        self.count = 0
+        self.total = 0.0
+        self.rows = 0
+        self.statements = 0
+        self.durations = deque(maxlen=samples_kept)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.durations.append(duration)
+
+    def p95(self):
+        return _percentile(self.durations, 0.95)
+
+
+class _Call(object):
+    """A call to a traced function that has yet to return"""
+
+    __slots__ = ['name', 'elapsed', 'statements']
+
+    def __init__(self, name):
+        self.name = name
+        self.elapsed = 0.0
+        self.statements = []
+
+
+class QueryTracer(object):
+    """Collects timings of the calls made to data-layer functions and of the
+    statements they execute, to find out where db time goes. Calls taking
+    more than @slow_threshold seconds are written, with their statements, to
+    the slow-query log at @slow_log_url.
+
+    Statements are seen through `sqlite3.Connection.set_trace_callback`,
+    which only tells when a statement starts. A statement is timed until the
+    next one starts on the same thread, or the function that executed it
+    returns, so its time includes handling the rows in Python. Rows are
+    counted per function, as the items it returns or yields."""
+
+    # number of most recent durations kept for percentiles, per function or
+    # statement
+    samples_kept = 1000
+    # number of statements of a slow call written to the log
+    statements_logged = 20
+
+    def __init__(self, slow_log_url=None, slow_threshold=0.1):
+        self.slow_log_url = slow_log_url
+        self.slow_threshold = slow_threshold
+        self.enabled = False
+
+        self._functions = {}
+        self._statements = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stats_for(self, table, key):
+        stats = table.get(key)
+        if stats is None:
+            stats = table[key] = _Stats(self.samples_kept)
+        return stats
+
+    def attach(self, conn):
+        """Trace the statements executed on @conn"""
+        conn.set_trace_callback(self._on_statement)
+
+    def install(self, module):
+        """Replace the functions of @module that take a db connection as their
+        first argument with ones that are timed. Callers have to look them
+        up in @module, rather than keep references to the originals."""
+        for name, fn in list(vars(module).items()):
+            if (name.startswith('_')
+                    or not inspect.isfunction(fn)
+                    or fn.__module__ != module.__name__
+                    or hasattr(fn, '__wrapped__')):
+                continue
+
+            params = list(inspect.signature(fn).parameters)
+            if not params or params[0] != 'conn':
+                continue
+
+            setattr(module, name, self._wrap(fn, name))
+
+    def _wrap(self, fn, name):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def traced_generator(*args, **kwargs):
+                # only the time spent producing items counts, not the time
+                # the caller spends with them
+                call = _Call(name)
+                rows = 0
+                generator = fn(*args, **kwargs)
+                try:
+                    while True:
+                        self._enter(call)
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            break
+                        finally:
+                            self._leave(call)
+                        rows += 1
+                        yield item
+                finally:
+                    generator.close()
+                    self._record_call(call, rows)
+
+            return traced_generator
+
+        @functools.wraps(fn)
+        def traced(*args, **kwargs):
+            call = _Call(name)
+            result = None
+            self._enter(call)
+            try:
+                result = fn(*args, **kwargs)
+                return result
+            finally:
+                self._leave(call)
+                if result is None:
+                    rows = 0
+                elif isinstance(result, list):
+                    rows = len(result)
+                else:
+                    rows = 1
+                self._record_call(call, rows)
+
+        return traced
+
+    def _enter(self, call):
+        stack = getattr(self._local, 'calls', None)
+        if stack is None:
+            stack = self._local.calls = []
+        self._end_statement()
+        stack.append((call, time.perf_counter()))
+
+    def _leave(self, call):
+        self._end_statement()
+        call, started = self._local.calls.pop()
+        call.elapsed += time.perf_counter() - started
+
+    def _on_statement(self, sql):
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        current = getattr(self._local, 'statement', None)
+        # statements run by triggers are reported again as the statement that
+        # fired them, which is still the same execution
+        if current is not None and current[0] == sql:
+            return
+
+        self._end_statement(now)
+        self._local.statement = (sql, now)
+
+        stack = getattr(self._local, 'calls', None)
+        if stack:
+            call = stack[-1][0]
+            if len(call.statements) < self.statements_logged:
+                call.statements.append(sql)
+
+    def _end_statement(self, now=None):
+        """Record the statement still running on this thread, if any"""
+        current = getattr(self._local, 'statement', None)
+        if current is None:
+            return
+
+        self._local.statement = None
+        sql, started = current
+        duration = (now or time.perf_counter()) - started
+        key = normalize_statement(sql)
+        stack = getattr(self._local, 'calls', None)
+        with self._lock:
+            self._stats_for(self._statements, key).add(duration)
+            if stack:
+                self._stats_for(self._functions, stack[-1][0].name).statements += 1
+
+    def _record_call(self, call, rows):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            stats = self._stats_for(self._functions, call.name)
+            stats.add(call.elapsed)
+            stats.rows += rows
+
+        if call.elapsed >= self.slow_threshold:
+            self._log_slow_call(call, rows)
+
+    def _log_slow_call(self, call, rows):
+        if self.slow_log_url is None:
+            return
+
+        lines = ['%s %s took %.1f ms, %d rows\n' % (
+            datetime.now().isoformat(timespec='milliseconds'),
+            call.name, call.elapsed * 1000, rows)]
+        lines.extend('    %s\n' % normalize_statement(sql)
+                     for sql in call.statements)
+        try:
+            with self._lock, open(self.slow_log_url, 'a') as log_file:
+                log_file.writelines(lines)
+        except OSError:
+            # TODO (notify): slow-query log could not be written
+            pass
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        with self._lock:
+            self._functions = {}
+            self._statements = {}
+
+    def stats(self):
+        """Return dicts of counters, one for functions and one for statements,
+        keyed by function name and normalized statement respectively"""
+        def as_dict(stats):
+            return {
+                'count': stats.count,
+                'total': stats.total,
+                'p95': stats.p95(),
+                'rows': stats.rows,
+                'statements': stats.statements
+            }
+
+        with self._lock:
+            return {
+                'functions': {name: as_dict(stats)
+                              for name, stats in self._functions.items()},
+                'statements': {sql: as_dict(stats)
+                               for sql, stats in self._statements.items()}
+            }
+
+    def summary(self, limit=20):
+        """Return a printable table of the @limit functions and statements
+        that took the most time in total"""
+        stats = self.stats()
+        lines = ['%-32s %7s %10s %9s %9s %8s %9s' % (
+            'function', 'calls', 'total ms', 'mean ms', 'p95 ms', 'rows',
+            'stmts')]
+        functions = sorted(stats['functions'].items(),
+                           key=lambda item: item[1]['total'], reverse=True)
+        for name, values in functions[:limit]:
+            lines.append('%-32s %7d %10.1f %9.2f %9.2f %8d %9d' % (
+                name, values['count'], values['total'] * 1000,
+                values['total'] * 1000 / max(values['count'], 1),
+                values['p95'] * 1000, values['rows'], values['statements']))
+
+        lines.append('')
+        lines.append('%7s %10s %9s  %s' % ('count', 'total ms', 'p95 ms',
+                                           'statement'))
+        statements = sorted(stats['statements'].items(),
+                            key=lambda item: item[1]['total'], reverse=True)
+        for sql, values in statements[:limit]:
+            if len(sql) > 100:
+                sql = sql[:97] + '...'
+            lines.append('%7d %10.1f %9.2f  %s' % (
+                values['count'], values['total'] * 1000,
+                values['p95'] * 1000, sql))
+
+        return '\n'.join(lines)
@@ -115,7 +115,7 @@ def request_save_html_for_group(group):
     after another, treated as belonging to one single group."""
     group_id = group['id']
     texts_in_group = {}
-    with db.connect() as connection:
+    with db.connect(readonly=True) as connection:
 
         def append_texts_in_group(id):
             texts = data.texts_in_group(connection, id)
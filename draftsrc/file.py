@@ -14,8 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from os.path import join, sep
-from datetime import datetime
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import gi
 gi.require_version("GtkSource", "3.0")
@@ -28,6 +27,9 @@ BASE_INDEX_DIR = join(USER_DATA_DIR, 'indices')
 
 default_encoding = 'utf-8'
 
+# number of threads moving files at once
+move_workers = 8
+
 
 def init_storage():
     try:
@@ -113,6 +115,23 @@ def write_to_file(f, contents):
     return None
 
 
+def import_file(src_path, filename, parent_names):
+    """Copy the file at @src_path into the library, as @filename in the group
+    with @parent_names, making sure its contents are valid text. Returns True
+    if it could be copied."""
+    parent_dir = sep.join(parent_names)
+    f_src = Gio.File.new_for_path(src_path)
+    f_dest = Gio.File.new_for_path(join(BASE_TEXT_DIR, parent_dir, filename))
+    try:
+        success, contents, etag = f_src.load_contents(None)
+    except Exception as e:
+        # TODO: Warn file read failure
+        return False
+
+    contents = contents.decode(default_encoding, errors='replace')
+    return write_to_file(f_dest, contents) is not None
+
+
 def write_to_source_file_async(gsf, buffer):
 
     def write_buffer_cb(saver, res, user_data):
@@ -156,6 +175,8 @@ def create_dir_if_not_exists(f_path):
 
 
 def move_from_src_to_dest(src_path, dest_path):
+    """Move the file at @src_path to @dest_path, returns True if it could be
+    moved"""
     try:
         f_src = Gio.File.new_for_path(src_path)
         f_dest = Gio.File.new_for_path(dest_path)
@@ -166,8 +187,11 @@ def move_from_src_to_dest(src_path, dest_path):
         if e.code == Gio.IOErrorEnum.WOULD_MERGE and srcname == destname:
             f_dest.delete()
             f_src.move(f_dest, Gio.FileCopyFlags.OVERWRITE, None, None, None)
+            return True
         # TODO: Warn file move failure
-        return
+        return False
+
+    return True
 
 
 def move_file(filename, src_parent_names, dest_parent_names):
@@ -175,7 +199,21 @@ def move_file(filename, src_parent_names, dest_parent_names):
     dest_dir = sep.join(dest_parent_names)
     src_path = join(BASE_TEXT_DIR, source_dir, filename)
     dest_path = join(BASE_TEXT_DIR, dest_dir, filename)
-    move_from_src_to_dest(src_path, dest_path)
+    return move_from_src_to_dest(src_path, dest_path)
+
+
+def move_files(files, dest_parent_names):
+    """Move the files in @files, a list of (filename, parent_names) pairs, into
+    the directory for @dest_parent_names, several at a time. Returns the set
+    of the filenames that could be moved."""
+    def move(file_and_parents):
+        filename, parent_names = file_and_parents
+        return move_file(filename, parent_names, dest_parent_names)
+
+    with ThreadPoolExecutor(move_workers) as executor:
+        moved = executor.map(move, files)
+        return set(filename for (filename, parents), done in zip(files, moved)
+                   if done)
 
 
 def trash_file(filename, parent_names, untrash=False):
@@ -194,24 +232,3 @@ def delete_file_permanently(filename):
     f_path = join(TRASH_DIR, filename)
     f = Gio.File.new_for_path(f_path)
     f.delete_async(GLib.PRIORITY_DEFAULT, None, None, None)
-
-
-@contextmanager
-def make_backup(url):
-    file = Gio.File.new_for_path(url)
-
-    basename = file.get_basename()
-    parentname = file.get_parent().get_path()
-    backup_name = '.%s_%s' % (basename,
-                              datetime.now().isoformat(timespec='milliseconds'))
-    backup_path = join(parentname, backup_name)
-    backup_file = Gio.File.new_for_path(backup_path)
-    file.copy(backup_file, Gio.FileCopyFlags.OVERWRITE, None, None, None)
-
-    try:
-        yield
-    except Exception as e:
-        backup_file.copy(file, Gio.FileCopyFlags.OVERWRITE, None, None, None)
-        # TODO (notify): something went wrong
-    finally:
-        backup_file.delete()
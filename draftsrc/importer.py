@@ -0,0 +1,192 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from draftsrc import db
+from draftsrc import file
+from draftsrc import search
+from draftsrc.db import data
+
+# files with these extensions are imported as texts, others are ignored
+text_extensions = ('.md', '.markdown', '.txt')
+
+# number of threads copying files into the library at once
+copy_workers = 8
+
+logger = logging.getLogger(__name__)
+
+
+def _scan_folder(path):
+    """Return a list of the folders in the tree at @path, including itself, and
+    a list of the text files in them. Each folder is a dict with its 'name',
+    'dir' and the index of its 'parent' in the list, listed after its parent.
+    Each file is a dict with its 'path', 'title', 'mtime' and 'parent'."""
+    folders = [{'name': os.path.basename(os.path.normpath(path)),
+                'dir': path,
+                'parent': None}]
+    files = []
+
+    # folders are appended as they are found, so this visits all of them
+    for index, folder in enumerate(folders):
+        try:
+            entries = sorted(os.scandir(folder['dir']), key=lambda e: e.name)
+        except OSError:
+            # TODO (notify): folder could not be read
+            continue
+
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+
+            # links to folders are not followed, as they may well lead back
+            # to a folder being imported
+            if entry.is_dir(follow_symlinks=False):
+                folders.append({'name': entry.name,
+                                'dir': entry.path,
+                                'parent': index})
+                continue
+
+            title, extension = os.path.splitext(entry.name)
+            if entry.is_file() and extension.lower() in text_extensions:
+                files.append({'path': entry.path,
+                              'title': title,
+                              'mtime': entry.stat().st_mtime,
+                              'parent': index})
+
+    return folders, files
+
+
+def _creation_datetimes(conn, count):
+    """Return @count datetime strings in ascending order, all in the past and
+    none of them a creation datetime of an existing text or group, so that
+    the hash ids made from them are unique"""
+    in_use = data.creation_datetimes(conn)
+    moment = datetime.now()
+    one_ms = timedelta(milliseconds=1)
+
+    datetimes = []
+    while len(datetimes) < count:
+        moment -= one_ms
+        datetime_str = moment.isoformat(timespec='milliseconds')
+        if datetime_str not in in_use:
+            datetimes.append(datetime_str)
+
+    datetimes.reverse()
+    return datetimes
+
+
+def import_folder(path, parent_id=None, progress_fn=None):
+    """Import the folder at @path into the library, as a group in the group
+    with @parent_id, or at the top level if it is None. Folders within it
+    become groups within that group, and the Markdown and text files in them
+    become texts. Returns the id of the new group.
+
+    The files are copied by several threads at once, and then all groups and
+    texts are created in a single transaction. Files that could not be copied
+    are logged and left out. @progress_fn, if given, is called with the
+    number of files copied so far and the number of files in all, from the
+    calling thread."""
+    folders, files = _scan_folder(path)
+
+    with db.connect(readonly=True) as connection:
+        datetimes = _creation_datetimes(connection, len(folders) + len(files))
+        parent_path = None
+        if parent_id is not None:
+            parent_group = data.group_for_id(connection, parent_id)
+            parent_path = '/'.join(parent_group['parents'] +
+                                   [parent_group['hash_id']])
+
+    # hash ids are known beforehand, so files can be put in place before
+    # the texts they belong to are created
+    for folder, created in zip(folders, datetimes):
+        folder['created'] = created
+        folder['hash_id'] = data.hash_for_creation_datetime(created)
+        if folder['parent'] is None:
+            parents = [parent_path] if parent_path else []
+        else:
+            parents = [folders[folder['parent']]['path']]
+        folder['path'] = '/'.join(parents + [folder['hash_id']])
+        file.create_dir(folder['path'], [])
+
+    for text, created in zip(files, datetimes[len(folders):]):
+        text['created'] = created
+        text['hash_id'] = data.hash_for_creation_datetime(created)
+        modified = datetime.fromtimestamp(text['mtime'])
+        text['last_modified'] = modified.isoformat(timespec='milliseconds')
+
+    root_dir = os.path.join(file.BASE_TEXT_DIR, folders[0]['path'])
+    try:
+        with ThreadPoolExecutor(copy_workers) as executor:
+            futures = {executor.submit(file.import_file,
+                                       text['path'],
+                                       text['hash_id'],
+                                       [folders[text['parent']]['path']]): text
+                       for text in files}
+            failed = set()
+            for num_copied, future in enumerate(as_completed(futures), 1):
+                if not future.result():
+                    text = futures[future]
+                    logger.warning('Could not import %s', text['path'])
+                    failed.add(text['hash_id'])
+                if progress_fn:
+                    progress_fn(num_copied, len(files))
+
+        # texts are only made for the files that are in the library now
+        files = [text for text in files if text['hash_id'] not in failed]
+
+        with db.connect() as connection:
+            with db.transaction(connection):
+                next_id = data.next_group_id(connection)
+                groups = []
+                for index, folder in enumerate(folders):
+                    folder_parent = folder['parent']
+                    if folder_parent is None:
+                        folder_parent_id = parent_id
+                    else:
+                        folder_parent_id = next_id + folder_parent
+                    groups.append({'id': next_id + index,
+                                   'name': folder['name'],
+                                   'created': folder['created'],
+                                   'last_modified': folder['created'],
+                                   'parent_id': folder_parent_id,
+                                   'hash_id': folder['hash_id'],
+                                   'path': folder['path']})
+                data.create_groups(connection, groups)
+
+                text_ids = data.create_texts(connection, [{
+                    'title': text['title'],
+                    'created': text['created'],
+                    'last_modified': text['last_modified'],
+                    'parent_id': next_id + text['parent'],
+                    'hash_id': text['hash_id']
+                } for text in files])
+    except Exception as e:
+        # none of the copied files belong to any text now
+        shutil.rmtree(root_dir, ignore_errors=True)
+        raise e
+
+    # only the new texts need to be added to the index of the library
+    try:
+        search.add_texts_to_index(text_ids)
+    except Exception:
+        # TODO (notify): texts could not be indexed
+        logger.exception('Could not index the imported texts')
+
+    return next_id
@@ -39,7 +39,7 @@ def _obtain_group_index_dirname(group_id):
     """Obtain the directory where index is stored for the given group_id"""
     if group_id is None:
         return file.BASE_INDEX_DIR
-    with db.connect() as connection:
+    with db.connect(readonly=True) as connection:
         group = data.group_for_id(connection, group_id)
         dirname = file.create_index_dir(group['hash_id'], group['parents'])
         return dirname
@@ -47,7 +47,7 @@ def _obtain_group_index_dirname(group_id):
 
 def create_index_for_group(group_id, in_trash):
     """Create an index of texts contained in given group or its children"""
-    with db.connect() as connection:
+    with db.connect(readonly=True) as connection:
         dirname = _obtain_group_index_dirname(group_id)
         ix = index.create_in(dirname, schema, INDEX_NAME)
         writer = ix.writer()
@@ -56,15 +56,14 @@ def create_index_for_group(group_id, in_trash):
 
             def add_text(text):
                 if text['in_trash'] == in_trash:
-                    writer.add_document(id=str(text['id']),
-                                        title=text['title'],
-                                        tags=' '.join(text['tags']))
+                    # each text is added once, along with its contents
                     contents = file.read_from_file(text['hash_id'],
                                                    text['parents'],
                                                    in_trash)
-                    if contents:
-                        writer.update_document(id=str(text['id']),
-                                               content=contents)
+                    writer.add_document(id=str(text['id']),
+                                        title=text['title'],
+                                        tags=' '.join(text['tags']),
+                                        content=contents or '')
 
             def add_texts_in_group(id):
                 for text in data.texts_in_group(connection, id):
@@ -88,6 +87,73 @@ def create_index_for_group(group_id, in_trash):
         return ix
 
 
+def add_texts_to_index(text_ids):
+    """Add the texts with given ids, along with their contents, to the index
+    of the whole library, if there is one, e.g. once they have been imported.
+    Texts already in the index are replaced."""
+    dirname = _obtain_group_index_dirname(None)
+    if not index.exists_in(dirname, INDEX_NAME):
+        return
+
+    ix = index.open_dir(dirname, INDEX_NAME, schema=schema)
+    try:
+        writer = ix.writer()
+    except index.LockError:
+        # TODO: (notify) Index locked! It is being created afresh anyway.
+        return
+
+    try:
+        with db.connect(readonly=True) as connection:
+            for text in data.texts_for_ids(connection, text_ids):
+                contents = file.read_from_file(text['hash_id'],
+                                               text['parents'],
+                                               text['in_trash'])
+                writer.update_document(id=str(text['id']),
+                                       title=text['title'],
+                                       tags=' '.join(text['tags']),
+                                       content=contents or '')
+        writer.commit()
+    except Exception:
+        writer.cancel()
+        raise
+
+
+def update_tags_for_texts(text_ids):
+    """Update the tags of texts with given ids in the index of the whole
+    library, if there is one, with their tags in db. Other fields are kept
+    as they are stored in the index, so no file is read."""
+    dirname = _obtain_group_index_dirname(None)
+    if not index.exists_in(dirname, INDEX_NAME):
+        return
+
+    with db.connect(readonly=True) as connection:
+        tags = {str(text['id']): ' '.join(text['tags'])
+                for text in data.texts_for_ids(connection, text_ids)}
+
+    ix = index.open_dir(dirname, INDEX_NAME, schema=schema)
+    try:
+        writer = ix.writer()
+    except index.LockError:
+        # TODO: (notify) Index locked! It is being created afresh anyway.
+        return
+
+    # the index stays locked until the writer is committed or cancelled
+    try:
+        with ix.searcher() as s:
+            for id, text_tags in tags.items():
+                stored = s.document(id=id)
+                if stored is None:
+                    continue
+                writer.update_document(id=id,
+                                       title=stored.get('title', ''),
+                                       content=stored.get('content', ''),
+                                       tags=text_tags)
+        writer.commit()
+    except Exception:
+        writer.cancel()
+        raise
+
+
 class CustomFormatter(highlight.Formatter):
     """Custom formatter for the matched terms."""
     between = '...\n'
@@ -400,6 +400,12 @@ class DraftLibraryView(Gtk.Bin):
         self._creation_state = True
         GLib.idle_add(prepare_for_popup)
 
+    def reload_groups(self, group_id=None):
+        """Load the groups afresh, e.g. after many have been added at once,
+        and select the group with @group_id"""
+        self.local_groups_view.set_collection_model()
+        self.selection_request(group_id)
+
     def selection_request(self, group_id, in_trash=False):
         if in_trash:
             self.trash_view.select_for_id(group_id)
@@ -63,7 +63,7 @@ class DraftGroupTreeStore(Gtk.TreeStore):
 
     def _load_data(self):
         """Load group data into tree model, according to groupt tree type"""
-        with db.connect() as connection:
+        with db.connect(readonly=True) as connection:
             for parent_group in data.groups_not_in_groups(connection):
                 self._append_group_and_children(connection, parent_group)
 
@@ -236,15 +236,6 @@ class DraftGroupTreeStore(Gtk.TreeStore):
                                group_dir_parents,
                                new_parent_dir_parents)
 
-            if trashed and self.tree_type == GroupTreeType.COLLECTION_GROUPS:
-                group = data.group_for_id(connection, group_id)
-                texts_to_be_trashed = self._all_texts_in_group(connection,
-                                                               group['id'],
-                                                               in_trash=False)
-                for text in texts_to_be_trashed:
-                    parent_list = texts_to_be_trashed[text]
-                    file.trash_file(text, parent_list)
-
             if not trashed and self.tree_type == GroupTreeType.TRASHED_GROUPS:
                 group = data.group_for_id(connection, group_id)
                 if group['parent_id'] is not None:
@@ -254,18 +245,21 @@ class DraftGroupTreeStore(Gtk.TreeStore):
                     # collection i.e., with no parents.
                     if parent_group['in_trash']:
                         values['parent_id'] = None
-                texts_to_be_restored = self._all_texts_in_group(connection,
-                                                                group['id'],
-                                                                in_trash=True)
-                for text in texts_to_be_restored:
-                    parent_list = texts_to_be_restored[text]
-                    # if group's parent is being set to NULL, then restore the
-                    # files within to correct locations accordingly
-                    if not values['parent_id']:
-                        parent_list = parent_list[parent_list.index(group['hash_id']):]
-                    file.trash_file(text, parent_list, untrash=True)
-
-            data.update_group(connection, group_id, values)
+
+            changed_text_ids = data.update_group(connection, group_id, values)
+
+            # move files for texts that were trashed or restored along with
+            # the group; their parents are already up to date in the db
+            move_files = False
+            if trashed and self.tree_type == GroupTreeType.COLLECTION_GROUPS:
+                move_files = True
+            if not trashed and self.tree_type == GroupTreeType.TRASHED_GROUPS:
+                move_files = True
+            if move_files and changed_text_ids:
+                for text in data.texts_for_ids(connection, changed_text_ids):
+                    file.trash_file(text['hash_id'],
+                                    text['parents'],
+                                    untrash=not trashed)
 
         if trashed and self.tree_type != GroupTreeType.TRASHED_GROUPS:
             self.remove(treeiter)
@@ -323,7 +317,7 @@ class DraftGroupTreeStore(Gtk.TreeStore):
         values = self.get_group_for_iter(treeiter)
         group_id = values['id']
         texts_to_be_deleted = []
-        with db.connect() as connection:
+        with db.connect(readonly=True) as connection:
             texts_to_be_deleted = self._all_texts_in_group(connection,
                                                            group_id,
                                                            in_trash=True)
@@ -342,7 +336,7 @@ class DraftGroupTreeStore(Gtk.TreeStore):
         group_id = group['id']
         in_trash = group['in_trash']
 
-        with db.connect() as connection:
+        with db.connect(readonly=True) as connection:
             if self._iter_is_top_level(treeiter) and in_trash:
                 return self.iter_n_children(self._top_level_iter)
             return data.count_groups(connection, group_id, in_trash)
@@ -354,7 +348,7 @@ class DraftGroupTreeStore(Gtk.TreeStore):
         in_trash = group['in_trash']
 
         count = 0
-        with db.connect() as connection:
+        with db.connect(readonly=True) as connection:
             count += data.count_texts(connection, group_id, in_trash)
             if self._iter_is_top_level(treeiter) and in_trash:
                 count += data.count_texts_in_trash_but_not_parent(connection)
@@ -362,7 +356,7 @@ class DraftGroupTreeStore(Gtk.TreeStore):
         return count
 
     def get_last_modified_parent_id(self):
-        with db.connect() as connection:
+        with db.connect(readonly=True) as connection:
             parent_id = data.group_for_last_modified_text(connection)
             if parent_id is not None:
                 return parent_id[0]
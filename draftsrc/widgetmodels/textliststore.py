@@ -13,13 +13,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 from gettext import gettext as _
 
-from gi.repository import GObject, Gtk, Gio
+from gi.repository import GObject, Gtk, Gio, GLib
 
 from draftsrc import file, db
 from draftsrc.db import data
 
+logger = logging.getLogger(__name__)
+
 
 class TextListType(object):
     GROUP_TEXTS = 0
@@ -151,7 +154,7 @@ class TextRowData(GObject.Object):
         :param data_dict: A dictionary of sheet metadata
         """
         self.title = data_dict['title']
-        self.tags = data_dict['tags']
+        self.tags = list(data_dict['tags'])
         self.last_modified = data_dict['last_modified']
         self.hash_id = data_dict['hash_id']
         self.in_trash = bool(data_dict['in_trash'])
@@ -176,6 +179,10 @@ class DraftTextListStore(Gio.ListStore):
 
     _item_changed_handlers = {}
 
+    # number of texts loaded at once; the first page is loaded right away and
+    # the rest while the app is idle, so that large lists show up quickly
+    page_size = 50
+
     def __repr__(self):
         return '<DraftListStore>'
 
@@ -190,6 +197,12 @@ class DraftTextListStore(Gio.ListStore):
         Gio.ListStore.__init__(self, item_type=TextRowData.__gtype__)
         self._list_type = list_type
         self.trashed_texts_only = trashed
+        # number of texts found in db when the model was loaded
+        self.num_texts = 0
+        self.loading_page = False
+        self._page_source_id = None
+        self._page_cursor = None
+        self._page_conditions = None
 
         if self._list_type == TextListType.GROUP_TEXTS:
             assert parent_group is not None
@@ -202,61 +215,143 @@ class DraftTextListStore(Gio.ListStore):
 
     def _load_texts(self):
         """Asks db to fetch the set of texts according to init conditions"""
+        self.stop_loading()
+        self._page_cursor = None
+        self._page_conditions = None
         self.remove_all()
-        with db.connect() as connection:
-            load_fn = None
-            kwargs = {}
-            load_orphan_trash = False
-            if self._list_type == TextListType.GROUP_TEXTS:
-                if self._parent_group['id']:
-                    load_fn = data.texts_in_group
-                    kwargs = {
-                        'conn': connection,
-                        'group_id': self._parent_group['id']
-                    }
-                else:
-                    load_fn = data.texts_not_in_groups
-                    kwargs = {'conn': connection}
-                    if self.trashed_texts_only:
-                        load_orphan_trash = True
-            elif self._list_type == TextListType.RECENT_TEXTS:
-                load_fn = data.texts_recently_modified
-                kwargs = {'conn': connection}
-            elif self._list_type == TextListType.RESULT_TEXTS:
-
-                def texts_in_results(conn, results):
-                    for text_id in results:
-                        text_id = int(text_id)
-                        yield data.text_for_id(conn, text_id)
-
-                load_fn = texts_in_results
-                kwargs = {
-                    'conn': connection,
-                    'results': self._results
-                }
+        if self._list_type == TextListType.RESULT_TEXTS:
+            self._load_results()
+            return
+
+        # the conditions are kept for all pages, as those for recent texts
+        # change with time
+        self._page_conditions = self._text_conditions()
+        where, args = self._page_conditions
+        with db.connect(readonly=True) as connection:
+            self.num_texts = data.count_texts_matching(connection, where, args)
+
+        def on_idle():
+            # the remaining pages may have been loaded already, see load_texts
+            if self._page_cursor is not None:
+                self._load_next_page()
+            if self._page_cursor is None:
+                self._page_source_id = None
+                return GLib.SOURCE_REMOVE
+            return GLib.SOURCE_CONTINUE
+
+        self._load_next_page()
+        if self._page_cursor is not None:
+            self._page_source_id = GLib.idle_add(on_idle)
+
+    def _load_next_page(self):
+        """Append the next page of texts to the model, or the first one if
+        none has been loaded yet"""
+        where, args = self._page_conditions
+        with db.connect(readonly=True) as connection:
+            texts, cursor = data.fetch_texts_page(connection,
+                                                  where,
+                                                  args,
+                                                  cursor=self._page_cursor,
+                                                  page_size=self.page_size)
+        rows = [self._row_data_for_text(text) for text in texts]
+        self._page_cursor = cursor
+        self.loading_page = True
+        try:
+            self.splice(self.get_n_items(), 0, rows)
+        finally:
+            self.loading_page = False
+
+    def load_text(self, text_id):
+        """Make sure the text with ``text_id`` is loaded into the model, if it
+        belongs in it, by loading the pages up to it right away rather than
+        waiting for them to be loaded while idle
+
+        :param text_id: A valid DB ID of a text
+
+        :returns: The position of the text within the model if it belongs in
+                  it, otherwise None
+        :rtype: int or None
+        """
+        self.load_texts([text_id])
+        return self.get_position_for_id(text_id)
+
+    def load_texts(self, text_ids):
+        """Make sure the texts with ids in ``text_ids`` that belong in the
+        model are loaded into it, like ``load_text`` does for one text
+
+        :param text_ids: A list of valid DB IDs of texts
+        """
+        if self._page_cursor is None:
+            return
+
+        loaded_ids = set(self.get_item(i).id
+                         for i in range(self.get_n_items()))
+        missing_ids = set(text_ids) - loaded_ids
+        if not missing_ids:
+            return
+
+        # no need to load every page for texts that are not in this list
+        where, args = self._page_conditions
+        ids = ', '.join(str(int(text_id)) for text_id in missing_ids)
+        with db.connect(readonly=True) as connection:
+            num_missing = data.count_texts_matching(
+                connection, '(%s) AND id IN (%s)' % (where, ids), args)
+
+        while num_missing and self._page_cursor is not None:
+            start = self.get_n_items()
+            self._load_next_page()
+            for i in range(start, self.get_n_items()):
+                if self.get_item(i).id in missing_ids:
+                    num_missing -= 1
+
+    def _text_conditions(self):
+        """Get the constraints, and their arguments, on texts that belong in
+        this model"""
+        conditions = ['in_trash = :in_trash']
+        args = {'in_trash': int(self.trashed_texts_only)}
+        if self._list_type == TextListType.GROUP_TEXTS:
+            if self._parent_group['id']:
+                conditions.append('parent_id = :group_id')
+                args['group_id'] = self._parent_group['id']
+            elif self.trashed_texts_only:
+                # trashed texts whose parents are not, are shown at top level
+                conditions.append('''(parent_id IS NULL
+                                      OR parent_id IN (SELECT id
+                                                         FROM "group"
+                                                        WHERE in_trash = 0))''')
             else:
-                load_fn = data.fetch_texts
-                kwargs = {'conn': connection}
-
-            for text in load_fn(**kwargs):
-                row = self._row_data_for_text(text)
-                if self.trashed_texts_only and row.in_trash:
-                    self.append(row)
-                elif not self.trashed_texts_only and not row.in_trash:
-                    self.append(row)
-            if load_orphan_trash:
-                for text in data.texts_in_trash_but_not_parent(connection):
-                    row = self._row_data_for_text(text)
-                    self.append(row)
+                conditions.append('parent_id IS NULL')
+        elif self._list_type == TextListType.RECENT_TEXTS:
+            conditions.append('last_modified >= :n_days_ago')
+            args['n_days_ago'] = db.get_datetime_last_n_days(7)
+
+        return ' AND '.join(conditions), args
+
+    def _load_results(self):
+        """Load the texts that are in search results"""
+        with db.connect(readonly=True) as connection:
+            rows = []
+            for text_id in self._results:
+                text = data.text_for_id(connection, int(text_id))
+                if bool(text['in_trash']) == self.trashed_texts_only:
+                    rows.append(self._row_data_for_text(text))
+            self.splice(0, 0, rows)
+            self.num_texts = len(rows)
+
+    def stop_loading(self):
+        """Stop loading any further pages of texts, e.g. when the model is no
+        longer going to be used"""
+        if self._page_source_id is not None:
+            GLib.source_remove(self._page_source_id)
+            self._page_source_id = None
 
     def _row_data_for_text(self, text_metadata):
         """Create TextRowData for one text document
 
-        :param text_metadata: A dict of metadata"""
-        if self._list_type == TextListType.RESULT_TEXTS:
-            text_id = str(text_metadata['id'])
-            text_metadata['misc'] = self._results[text_id]
+        :param text_metadata: A TextRecord or dict of metadata"""
         row_data = TextRowData.from_dict(text_metadata)
+        if self._list_type == TextListType.RESULT_TEXTS:
+            row_data.misc = self._results[str(text_metadata['id'])]
         handler_id = row_data.connect('changed', self._on_row_data_changed)
         self._item_changed_handlers[row_data] = handler_id
         return row_data
@@ -285,6 +380,9 @@ class DraftTextListStore(Gio.ListStore):
                 self.delete_item_at_postion(position)
             elif prop_name == 'in_trash' and not item.in_trash:
                 self.restore_item_at_position(position)
+            elif prop_name in ['last_edit_position', 'word_goal']:
+                self.save_for_position(position, low_priority=True)
+                self.items_changed(position, 0, 0)
             else:
                 self.save_for_position(position)
                 self.items_changed(position, 0, 0)
@@ -300,7 +398,9 @@ class DraftTextListStore(Gio.ListStore):
                                        self._parent_group['id'])
             text = data.text_for_id(connection, text_id)
             text_row = self._row_data_for_text(text)
-            return self.append(text_row)
+
+            # texts are listed latest modified first
+            self.insert(0, text_row)
 
     def prepare_for_edit(self, positions, switch_view, load_file):
         """Prepare text at ``position`` in ``self`` to be edited
@@ -332,16 +432,23 @@ class DraftTextListStore(Gio.ListStore):
                                         load_file,
                                         in_trash)
 
-    def save_for_position(self, position):
+    def save_for_position(self, position, low_priority=False):
         """Update DB with current metdata for TextRowData at given position
 
         :param position: A non-negative integer position of item to be updated
+        :param low_priority: If True, the update is written along with others
+                             at the next periodic flush, instead of right away
         """
         item = self.get_item(position)
         id = item.id
         item.last_modified = db.get_datetime()
 
-        db.async_text_updater.enqueue(id, item.to_dict())
+        if low_priority:
+            db.timed_updater.enqueue(id, item.to_dict())
+        else:
+            # the update carries all metadata, so pending ones are obsolete
+            db.timed_updater.remove_if_exists(id)
+            db.async_text_updater.enqueue(id, item.to_dict())
         self.dequeue_final_save(id)
 
     def save_parent_for_position(self, position):
@@ -379,6 +486,85 @@ class DraftTextListStore(Gio.ListStore):
             if self._parent_group and parent != self._parent_group:
                 self.remove(position)
 
+    def move_texts_to_group(self, text_ids, group_id):
+        """Move the texts with given ids that are in this model to the group
+        with given id all at once, along with their files. Texts whose files
+        could not be moved are left where they are.
+
+        :param text_ids: A list of valid text ids
+        :param group_id: A valid group id, or None for the top level
+        """
+        text_ids = set(text_ids)
+        positions = [position for position in range(self.get_n_items())
+                     if self.get_item(position).id in text_ids
+                     and self.get_item(position).parent_id != group_id]
+        if not positions:
+            return
+
+        items = {self.get_item(position).id: self.get_item(position)
+                 for position in positions}
+        with db.connect(readonly=True) as connection:
+            texts = data.texts_for_ids(connection, list(items))
+            files = [(text['hash_id'], list(text['parents']))
+                     for text in texts]
+            group_dir_parents = []
+            if group_id is not None:
+                group = data.group_for_id(connection, group_id)
+                group_dir_parents = group['parents'] + [group['hash_id']]
+
+        # files are moved first, and without holding up the writer, so that
+        # only texts whose files did move are moved in db
+        moved_files = file.move_files(files, group_dir_parents)
+        moved_ids = [item.id for item in items.values()
+                     if item.hash_id in moved_files]
+        if len(moved_ids) < len(items):
+            # TODO (notify): some texts could not be moved
+            logger.warning('Could not move the files of %d texts',
+                           len(items) - len(moved_ids))
+        if not moved_ids:
+            return
+
+        datetime = db.get_datetime()
+        with db.connect() as connection:
+            data.move_texts_to_group(connection, moved_ids, group_id, datetime)
+
+        for id in moved_ids:
+            item = items[id]
+            handler_id = self._item_changed_handlers.get(item)
+            if handler_id is not None:
+                item.handler_block(handler_id)
+            try:
+                item.parent_id = group_id
+                item.parents = group_dir_parents
+                item.last_modified = datetime
+            finally:
+                if handler_id is not None:
+                    item.handler_unblock(handler_id)
+
+            # updates still waiting to be written must not undo the move
+            for queue in [db.async_text_updater,
+                          db.timed_updater,
+                          db.final_text_updater]:
+                queue.replace_if_exists(item.id, item.to_dict())
+
+        moved_ids = set(moved_ids)
+        moved = set(position for position in positions
+                    if self.get_item(position).id in moved_ids)
+        in_other_group = (self._list_type == TextListType.GROUP_TEXTS
+                          and group_id != self._parent_group['id'])
+        if in_other_group:
+            # a single change spanning all moved texts, keeping the others
+            # in between
+            first, last = min(moved), max(moved)
+            kept = [self.get_item(position)
+                    for position in range(first, last + 1)
+                    if position not in moved]
+            self.splice(first, last - first + 1, kept)
+        else:
+            # the texts stay listed, but show their new group
+            for position in sorted(moved):
+                self.items_changed(position, 0, 0)
+
     def queue_save(self, text_data):
         """Queue given metadata to be updated in DB, as soon as a connection is
         available for the operation
@@ -387,6 +573,7 @@ class DraftTextListStore(Gio.ListStore):
         """
         text_id = text_data.id
         db.final_text_updater.remove_if_exists(text_id)
+        db.timed_updater.remove_if_exists(text_id)
         db.async_text_updater.enqueue(text_id, text_data.to_dict())
 
     def queue_final_save(self, text_data):
@@ -479,7 +666,7 @@ class DraftTextListStore(Gio.ListStore):
         """
         item = self.get_item(position)
         if item.parent_id:
-            with db.connect() as connection:
+            with db.connect(readonly=True) as connection:
                 group = data.group_for_id(connection, item.parent_id)
                 return group
         return None
@@ -43,6 +43,7 @@ class DraftBaseList(Gtk.ListBox):
         'reveal-requested': (GObject.SignalFlags.RUN_FIRST, None, ()),
     }
 
+    _model = None
     _editor = None
     _double_click_in_progress = False
     _text_view_selection_in_progress = False
@@ -261,7 +262,8 @@ class DraftBaseList(Gtk.ListBox):
         if not hasattr(self, '_model'):
             return
 
-        position = self._model.get_position_for_id(text_id)
+        # the text may be in a page that is not loaded yet
+        position = self._model.load_text(text_id)
         if position is not None:
             row = self.get_row_at_index(position)
             if row and not row.is_selected():
@@ -535,6 +537,12 @@ class DraftTextList(DraftBaseList):
                 self.select_for_id(text_id)
 
     def _on_items_changed(self, model, position, removed, added):
+        if model.loading_page:
+            # more texts were paged into the model, leave the selection as is
+            for i in range(position, position + added):
+                self._connect_focus_based_styling(self.get_row_at_index(i))
+            return
+
         DraftBaseList.items_changed_base(self,
                                          model,
                                          position,
@@ -587,6 +595,9 @@ class DraftTextList(DraftBaseList):
         :param collection_class: A collection class type
         :param parent_group: A dictionary representing some group metadata
         """
+        if self._model is not None:
+            self._model.stop_loading()
+
         self._model = None
         if parent_group:
             if parent_group['in_trash']:
@@ -617,6 +628,7 @@ class DraftTextList(DraftBaseList):
         # select these newly-moved texts so that the user knows them to be
         if self._texts_being_moved:
             self.set_multi_selection_mode(len(self._texts_being_moved) > 1)
+            self._model.load_texts(self._texts_being_moved)
             for row in self.get_children():
                 position = row.get_index()
                 row_data = self._model.get_item(position)
@@ -651,7 +663,7 @@ class DraftTextList(DraftBaseList):
             adj.set_value(row_alloc.y + row_alloc.height - alloc.height)
 
     def new_text_request(self):
-        """Request for creation of a new text and append it to the list"""
+        """Request for creation of a new text and add it atop the list"""
         self._model.new_text_request()
         position = self._model.get_latest_modified_position()
         new_row = self.get_row_at_index(position)
@@ -660,8 +672,9 @@ class DraftTextList(DraftBaseList):
         self.emit('text-created')
 
         def scroll_to_new_row():
+            # the new text is the latest modified, so it is listed first
             adj = self.get_adjustment()
-            adj.set_value(adj.get_upper())
+            adj.set_value(adj.get_lower())
 
         GLib.idle_add(scroll_to_new_row)
 
@@ -674,11 +687,7 @@ class DraftTextList(DraftBaseList):
 
         :param text_ids: A list of valid text ids
         :param group: A valid group id to move the texts to"""
-        for id in text_ids:
-            position = self._model.get_position_for_id(id)
-            if position is not None:
-                item = self._model.get_item(position)
-                item.parent_id = group
+        self._model.move_texts_to_group(text_ids, group)
         self.emit('text-moved-to-group', group)
 
     def set_title_for_position(self, position, title):
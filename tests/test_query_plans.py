@@ -0,0 +1,228 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks that the queries run whenever texts and groups are listed or looked
+up are answered using indexes, rather than by scanning whole tables."""
+
+import builtins
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+# the db is created in the user data dir, which has to be set before draftsrc
+# is imported
+DATA_HOME = tempfile.mkdtemp()
+os.environ['XDG_DATA_HOME'] = DATA_HOME
+os.makedirs(os.path.join(DATA_HOME, 'draft'))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+builtins.__dict__.setdefault('_', lambda s: s)
+
+from draftsrc import db
+from draftsrc.db import data
+
+# tables that grow with the library; scanning the small ones is fine
+LARGE_TABLES = ('text', 'group', 'text_tags')
+
+# size of the library the queries are planned for, large enough that an index
+# pays off for the planner, whether or not it has statistics to go by
+NUM_GROUPS = 400
+NUM_TEXTS = 20000
+NUM_TAGS = 200
+
+full_scan = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?$')
+
+
+def setUpModule():
+    db.init_db('0.1.0')
+    groups = []
+    paths = {}
+    for group_id in range(1, NUM_GROUPS + 1):
+        # groups nest up to four levels deep, and the last one is in trash
+        parent_id = None if group_id % 4 == 1 else group_id - 1
+        paths[group_id] = 'g%d' % group_id
+        if parent_id is not None:
+            paths[group_id] = paths[parent_id] + '/' + paths[group_id]
+        groups.append((group_id,
+                       '2017-01-01T00:00:00.%06d' % group_id,
+                       '2017-01-01T00:00:00.000',
+                       parent_id,
+                       int(group_id == NUM_GROUPS),
+                       'g%d' % group_id,
+                       paths[group_id]))
+
+    texts = []
+    text_tags = []
+    for text_id in range(1, NUM_TEXTS + 1):
+        texts.append((text_id,
+                      'text %d' % (text_id % 997),
+                      '2017-01-01T00:01:00.%06d' % text_id,
+                      '2017-%02d-%02dT00:00:00.000' % (text_id % 12 + 1,
+                                                       text_id % 28 + 1),
+                      None if text_id % 10 == 0 else text_id % NUM_GROUPS + 1,
+                      int(text_id % 7 == 0),
+                      't%d' % text_id))
+        for i in range(2):
+            text_tags.append((text_id, 'tag %d' % ((text_id + i) % NUM_TAGS)))
+
+    with db.connect() as connection:
+        with db.transaction(connection):
+            cursor = connection.cursor()
+            cursor.executemany('''
+                INSERT INTO "group" (id, name, created, last_modified,
+                                     parent_id, in_trash, hash_id, path)
+                     VALUES (?, 'group', ?, ?, ?, ?, ?, ?)''', groups)
+            cursor.executemany('''
+                INSERT INTO text (id, title, created, last_modified,
+                                  parent_id, in_trash, hash_id)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)''', texts)
+            cursor.executemany('''
+                INSERT INTO tag (keyword)
+                     VALUES (?)''', [('tag %d' % i,) for i in range(NUM_TAGS)])
+            cursor.executemany('''
+                INSERT INTO text_tags (text_id, tag_keyword)
+                     VALUES (?, ?)''', text_tags)
+    db.metadata_cache.clear()
+
+
+def tearDownModule():
+    db.close()
+    shutil.rmtree(DATA_HOME, ignore_errors=True)
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    """Plans made without statistics, as for a db that has not been analyzed
+    yet"""
+
+    # whether the planner has the statistics `ANALYZE` gathers, as it does
+    # once a maintenance step has analyzed the db
+    analyzed = False
+
+    @classmethod
+    def setUpClass(cls):
+        with db.connect() as connection:
+            if cls.analyzed:
+                db.maintenance.analyze(connection)
+            elif connection.execute('''
+                    SELECT 1
+                      FROM sqlite_master
+                     WHERE name = 'sqlite_stat1'
+                    ''').fetchone():
+                connection.execute('DELETE FROM sqlite_stat1')
+        # statistics are read when a connection is opened
+        db.connection_pool.close()
+
+    def assertNoFullScans(self, fn, *args):
+        """Run @fn with a reader connection and @args, and check the plan of
+        every query it makes"""
+        statements = []
+        db.metadata_cache.clear()
+        with db.connect(readonly=True) as connection:
+            connection.set_trace_callback(statements.append)
+            try:
+                result = fn(connection, *args)
+                # most lookups return iterators, which query when consumed
+                if hasattr(result, '__next__'):
+                    list(result)
+            finally:
+                connection.set_trace_callback(None)
+
+            queries = [statement for statement in statements
+                       if statement.lstrip().upper().startswith(('SELECT',
+                                                                 'WITH'))]
+            self.assertTrue(queries, 'no queries were made')
+            for query in queries:
+                plan = connection.execute('EXPLAIN QUERY PLAN ' + query)
+                for row in plan:
+                    match = full_scan.match(row[3])
+                    if match and match.group(1) in LARGE_TABLES:
+                        self.fail('full scan of %s in:\n%s' % (match.group(1),
+                                                               query))
+
+    def test_texts_in_group(self):
+        self.assertNoFullScans(data.texts_in_group, 2)
+
+    def test_texts_not_in_groups(self):
+        self.assertNoFullScans(data.texts_not_in_groups)
+
+    def test_text_for_id(self):
+        self.assertNoFullScans(data.text_for_id, 3)
+
+    def test_texts_for_ids(self):
+        self.assertNoFullScans(data.texts_for_ids, [3, 4, 5])
+
+    def test_text_for_hash_id(self):
+        self.assertNoFullScans(data.text_for_hash_id, 't3')
+
+    def test_texts_with_tag(self):
+        self.assertNoFullScans(data.texts_with_tag, 'tag 3')
+
+    def test_texts_recently_modified(self):
+        self.assertNoFullScans(data.texts_recently_modified)
+
+    def test_group_for_last_modified_text(self):
+        self.assertNoFullScans(data.group_for_last_modified_text)
+
+    def test_fetch_tags_for_text(self):
+        self.assertNoFullScans(data.fetch_tags_for_text, 3)
+
+    def test_groups_in_group(self):
+        self.assertNoFullScans(data.groups_in_group, 1)
+
+    def test_group_for_id(self):
+        self.assertNoFullScans(data.group_for_id, 2)
+
+    def test_group_for_hash_id(self):
+        self.assertNoFullScans(data.group_for_hash_id, 'g2')
+
+    def test_count_texts(self):
+        self.assertNoFullScans(data.count_texts, 2)
+
+    def test_text_list_pages(self):
+        # the conditions text lists are loaded with, see `TextListStore`
+        conditions = [
+            ('in_trash = :in_trash AND parent_id = :group_id',
+             {'in_trash': 0, 'group_id': 2}),
+            ('in_trash = :in_trash AND parent_id IS NULL',
+             {'in_trash': 0}),
+            ('in_trash = :in_trash AND last_modified >= :n_days_ago',
+             {'in_trash': 0, 'n_days_ago': '2017-02-01T00:30:00.000'})
+        ]
+        for where, args in conditions:
+            for order_by in data.page_orders:
+                with self.subTest(where=where, order_by=order_by):
+                    def fetch_pages(conn):
+                        texts, cursor = data.fetch_texts_page(
+                            conn, where, args, order_by, page_size=10)
+                        data.fetch_texts_page(conn, where, args, order_by,
+                                              cursor, page_size=10)
+
+                    self.assertNoFullScans(fetch_pages)
+
+            with self.subTest(where=where):
+                self.assertNoFullScans(data.count_texts_matching, where, args)
+
+
+class AnalyzedQueryPlanTestCase(QueryPlanTestCase):
+    """Plans made with statistics gathered the way maintenance does"""
+
+    analyzed = True
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Counts the statements made and the time taken to fetch every text, with
+its parents and tags, from libraries of growing size. The library has nested
+groups and two tags per text. A digest of the fetched parents and tags is
+printed as well, to check that two trees return the same texts."""
+
+import time
+from hashlib import sha1
+
+import library
+
+
+def main():
+    parser = library.argument_parser(__doc__)
+    parser.add_argument('sizes', nargs='*', type=int,
+                        default=[1000, 10000, 100000],
+                        help='numbers of texts in library')
+    options = parser.parse_args()
+    db, data = library.load_draftsrc(options.tree)
+
+    print('%8s %12s %10s  %s' % ('texts', 'statements', 'time', 'digest'))
+    for size in options.sizes:
+        library.build_library(db, size, max(1, size // 50), nested=True)
+        statements = []
+        with db.connect(readonly=True) as connection:
+            connection.set_trace_callback(statements.append)
+            start = time.perf_counter()
+            texts = list(data.fetch_texts(connection))
+            elapsed = time.perf_counter() - start
+            connection.set_trace_callback(None)
+
+        digest = sha1(repr([(text['hash_id'],
+                             list(text['parents']),
+                             sorted(text['tags']))
+                            for text in texts]).encode()).hexdigest()
+        print('%8d %12d %9.3fs  %s' % (size, len(statements), elapsed,
+                                       digest[:12]))
+
+
+if __name__ == '__main__':
+    main()
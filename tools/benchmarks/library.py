@@ -0,0 +1,153 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Setup shared by the benchmarks: a throwaway data dir holding a db filled
+with a generated library. Every benchmark takes a --tree option, the checkout
+whose `draftsrc` is measured, so that numbers from before a change can be had
+by pointing it at a worktree of an older commit, e.g.
+
+    git worktree add /tmp/draft-old <commit>^
+    python3 tools/benchmarks/fetch_texts.py --tree /tmp/draft-old
+"""
+
+import argparse
+import atexit
+import builtins
+import os
+import random
+import shutil
+import sys
+import tempfile
+from hashlib import sha256
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+def argument_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--tree', default=ROOT,
+                        help='checkout whose draftsrc is measured '
+                             '(default: this one)')
+    return parser
+
+
+def load_draftsrc(tree):
+    """Import `draftsrc.db` from @tree, with its data dir in a temporary
+    directory, and set up an empty db. Return the `db` and `db.data`
+    modules."""
+    data_home = tempfile.mkdtemp()
+    os.makedirs(os.path.join(data_home, 'draft'))
+    os.environ['XDG_DATA_HOME'] = data_home
+    sys.path.insert(0, os.path.abspath(tree))
+    builtins.__dict__.setdefault('_', lambda s: s)
+
+    from draftsrc import db
+    from draftsrc.db import data
+    db.init_db('0.1.0')
+
+    def cleanup():
+        # older trees have no db.close()
+        if hasattr(db, 'close'):
+            db.close()
+        shutil.rmtree(data_home, ignore_errors=True)
+    atexit.register(cleanup)
+    return db, data
+
+
+def _insert(cursor, table, rows):
+    """Insert dicts @rows into @table, leaving out the keys it has no column
+    for, since older trees have fewer columns"""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info("%s")'
+                                                % table)]
+    keys = [key for key in rows[0] if key in columns]
+    query = 'INSERT INTO "%s" (%s) VALUES (%s)' % (
+        table, ', '.join(keys), ', '.join(':' + key for key in keys))
+    cursor.executemany(query, rows)
+
+
+def build_library(db, num_texts, num_groups, tags_per_text=2, num_tags=50,
+                  nested=False, trashed=0.0, ties=False, seed=1):
+    """Replace the contents of db with @num_texts texts in @num_groups groups,
+    each text with @tags_per_text out of @num_tags tags. If @nested, most
+    groups are put inside an earlier one. A fraction @trashed of texts is in
+    trash. If @ties, texts share last modified dates, like after an import."""
+    rng = random.Random(seed)
+    with db.connect() as connection:
+        cursor = connection.cursor()
+        cursor.execute('BEGIN')
+        for table in ('text_tags', 'tag', 'text', 'group'):
+            cursor.execute('DELETE FROM "%s"' % table)
+
+        groups = []
+        paths = {}
+        for group_id in range(1, num_groups + 1):
+            parent_id = None
+            if nested and groups and rng.random() < 0.8:
+                parent_id = rng.choice(groups)['id']
+            created = '2017-01-01T00:00:00.%06d' % group_id
+            hash_id = sha256(created.encode()).hexdigest()
+            paths[group_id] = hash_id
+            if parent_id is not None:
+                paths[group_id] = paths[parent_id] + '/' + hash_id
+            groups.append({
+                'id': group_id,
+                'name': 'group %d' % group_id,
+                'created': created,
+                'last_modified': '2017-01-01T00:00:00.000',
+                'parent_id': parent_id,
+                'in_trash': 0,
+                'hash_id': hash_id,
+                'path': paths[group_id]
+            })
+        if groups:
+            _insert(cursor, 'group', groups)
+
+        texts = []
+        for text_id in range(1, num_texts + 1):
+            if ties:
+                last_modified = '2017-%02d-%02dT00:00:00.000' % (
+                    rng.randint(1, 12), rng.randint(1, 28))
+            else:
+                last_modified = '2017-02-01T00:00:00.%06d' % text_id
+            parent_id = None
+            if groups and rng.random() < 0.9:
+                parent_id = rng.randint(1, num_groups)
+            created = '2017-01-01T00:00:01.%06d' % text_id
+            texts.append({
+                'id': text_id,
+                'title': 'text %d' % rng.randint(0, num_texts // 10),
+                'created': created,
+                'last_modified': last_modified,
+                'parent_id': parent_id,
+                'in_trash': int(rng.random() < trashed),
+                'hash_id': sha256(created.encode()).hexdigest(),
+                'markup': 'markdown',
+                'subtitle': 'subtitle %d' % text_id,
+                'word_goal': 0,
+                'last_edit_position': 0
+            })
+        _insert(cursor, 'text', texts)
+
+        keywords = ['tag %d' % i for i in range(num_tags)]
+        cursor.executemany('INSERT INTO tag (keyword) VALUES (?)',
+                           [(keyword,) for keyword in keywords])
+        cursor.executemany(
+            'INSERT INTO text_tags (text_id, tag_keyword) VALUES (?, ?)',
+            [(text_id, keyword)
+             for text_id in range(1, num_texts + 1)
+             for keyword in rng.sample(keywords, tags_per_text)])
+        cursor.execute('COMMIT')
+        cursor.execute('ANALYZE')
@@ -0,0 +1,96 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Times what a text list does before showing its first rows: loading every
+text that is not in trash, as text lists did before paging, against counting
+them and fetching the first page in either order. The last page is timed too,
+and all pages are checked to add up to the fully sorted list. The library has
+many texts modified at the same time, and a tenth of them in trash."""
+
+import time
+
+import library
+
+WHERE = 'in_trash = :in_trash'
+ARGS = {'in_trash': 0}
+PAGE_SIZE = 50
+
+
+def best_of(repeat, fn):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = library.argument_parser(__doc__)
+    parser.add_argument('size', nargs='?', type=int, default=100000,
+                        help='number of texts in library')
+    options = parser.parse_args()
+    db, data = library.load_draftsrc(options.tree)
+    library.build_library(db, options.size, 100, tags_per_text=1,
+                          trashed=0.1, ties=True)
+
+    def full_load():
+        with db.connect(readonly=True) as connection:
+            return [text for text in data.fetch_texts(connection)
+                    if not text['in_trash']]
+
+    print('%-34s %.4fs' % ('full load', best_of(3, full_load)))
+    if not hasattr(data, 'fetch_texts_page'):
+        print('no paging in this tree')
+        return
+
+    for order_by, descending in data.page_orders.items():
+        def first_page():
+            with db.connect(readonly=True) as connection:
+                data.count_texts_matching(connection, WHERE, ARGS)
+                data.fetch_texts_page(connection, WHERE, ARGS, order_by,
+                                      page_size=PAGE_SIZE)
+
+        print('%-34s %.4fs' % ('count + first page, ' + order_by,
+                               best_of(3, first_page)))
+
+        ids = []
+        cursor = None
+        with db.connect(readonly=True) as connection:
+            while True:
+                start = time.perf_counter()
+                texts, cursor = data.fetch_texts_page(connection, WHERE, ARGS,
+                                                      order_by, cursor,
+                                                      PAGE_SIZE)
+                elapsed = time.perf_counter() - start
+                ids.extend(text['id'] for text in texts)
+                if cursor is None:
+                    break
+
+            pages = (len(ids) + PAGE_SIZE - 1) // PAGE_SIZE
+            print('%-34s %.4fs' % ('page %d of %d, %s' % (pages, pages,
+                                                          order_by),
+                                   elapsed))
+
+            direction = 'DESC' if descending else 'ASC'
+            query = 'SELECT id FROM text WHERE {} ORDER BY {} {}, id {}'
+            expected = [row[0] for row in connection.execute(
+                query.format(WHERE, order_by, direction, direction), ARGS)]
+            print('%-34s %s' % ('pages match sorted list',
+                                ids == expected))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# Copyright (C) 2017  Saiful Bari Khan <saifulbkhan@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures, with tracemalloc, the memory held by every text fetched from a
+library, and by list rows built from them, along with the time it takes to
+fetch texts and build rows. The library has 200 groups and two tags per
+text."""
+
+import gc
+import time
+import tracemalloc
+
+import library
+
+
+class Row(object):
+    """Stands in for `TextRowData`, copying the same fields, so that rows can
+    be measured without GObject"""
+
+    def __init__(self, text):
+        self.title = text['title']
+        self.tags = list(text['tags'])
+        self.last_modified = text['last_modified']
+        self.hash_id = text['hash_id']
+        self.in_trash = bool(text['in_trash'])
+        self.parent_id = text['parent_id']
+        self.parents = text['parents']
+        self.markup = text['markup']
+        self.subtitle = text['subtitle']
+        self.word_goal = text['word_goal'] or 0
+        self.last_edit_position = text['last_edit_position'] or 0
+        self.misc = None
+
+
+def measure(db, fn):
+    """Return the MiB held by the result of @fn, run with a reader
+    connection"""
+    gc.collect()
+    tracemalloc.start()
+    with db.connect(readonly=True) as connection:
+        result = fn(connection)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size / 2**20
+
+
+def main():
+    parser = library.argument_parser(__doc__)
+    parser.add_argument('size', nargs='?', type=int, default=50000,
+                        help='number of texts in library')
+    options = parser.parse_args()
+    db, data = library.load_draftsrc(options.tree)
+    library.build_library(db, options.size, 200, num_tags=40)
+
+    def fetched(connection):
+        return list(data.fetch_texts(connection))
+
+    def rows(connection):
+        return [Row(text) for text in data.fetch_texts(connection)]
+
+    for name, fn in [('fetched list', fetched), ('rows', rows)]:
+        print('%-14s %6.1f MiB' % (name, measure(db, fn)))
+
+    def load():
+        with db.connect(readonly=True) as connection:
+            rows(connection)
+
+    times = []
+    for i in range(3):
+        start = time.perf_counter()
+        load()
+        times.append(time.perf_counter() - start)
+    print('%-14s %6.2fs' % ('fetch + build', min(times)))
+
+
+if __name__ == '__main__':
+    main()